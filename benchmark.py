@@ -0,0 +1,301 @@
+import argparse
+import json
+import logging
+import sys
+import time
+import traceback
+from datetime import date, timedelta
+from multiprocessing import Process, Queue
+from os.path import join, dirname, abspath, basename, exists
+
+import numpy as np
+import pandas as pd
+import shapefile
+
+from generate_weather_report import check_csv_files_for_right_structure, get_data_frames_tasks, get_daily_tasks, \
+    get_monthly_tasks, DATA_FRAMES_DIR, DAILY_RESULTS_DIR, MONTHLY_RESULTS_DIR, RAW_DATA_DIR
+from frame_store import NPY_FRAME_FORMAT, get_frame_extension
+from station_catalogue import build_station_catalogue
+from utils import configure_logging, run_tasks, clear_dir, mkpath, get_shape_file_and_correspondent_stations, \
+    get_files_for_getting_daily_metrics, format_memory_size
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+BASELINE_FILE_NAME = join(dirname(abspath(__file__)), 'benchmark_baseline.json')
+RESULTS_FILE_NAME = 'benchmark_results.json'
+CSV_HEADER = ['STATION', 'STATION_NAME', 'ELEVATION', 'LATITUDE', 'LONGITUDE', 'DATE', 'MDPR', 'DAPR', 'PRCP', 'SNWD',
+              'SNOW', 'TMAX', 'TMIN']
+AREA_SIZE = 10.0
+MISSING_ROWS_SHARE = 0.1
+MISSING_VALUES_SHARE = 0.1
+MASKED_CELLS_SHARE = 0.1
+START_DATE = date(2000, 1, 1)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark weather report stages on synthetic data')
+    parser.add_argument('--work-dir', default='BENCHMARK', help='folder for synthetic data and outputs')
+    parser.add_argument('--stations', type=int, default=200, help='number of stations')
+    parser.add_argument('--years', type=int, default=2, help='number of years of daily data')
+    parser.add_argument('--files', type=int, default=4, help='number of raw csv files')
+    parser.add_argument('--sections', type=int, default=4, help='number of sections and basein files')
+    parser.add_argument('--grid-size', type=int, default=50, help='basein grid resolution (cells per side)')
+    parser.add_argument('--workers', type=int, default=0, help='number of workers, defaults to the number of CPUs')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--baseline', default=BASELINE_FILE_NAME, help='baseline results file')
+    parser.add_argument('--save-baseline', action='store_true', help='store results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative slowdown or memory growth against the baseline')
+    parser.add_argument('--verbose', action='store_true', help='log pipeline messages')
+    return parser.parse_args()
+
+
+def get_parameters(arguments):
+    return {'stations': arguments.stations, 'years': arguments.years, 'files': arguments.files,
+            'sections': arguments.sections, 'grid_size': arguments.grid_size, 'workers': arguments.workers,
+            'seed': arguments.seed}
+
+
+def generate_stations(stations_count, random_state):
+    names = ['BENCH:%06d' % idx for idx in range(stations_count)]
+    longitudes = random_state.uniform(0, AREA_SIZE, stations_count)
+    latitudes = random_state.uniform(0, AREA_SIZE, stations_count)
+    return names, longitudes, latitudes
+
+
+def generate_raw_csv_files(csv_path, stations, days_count, files_count, random_state):
+    names, longitudes, latitudes = stations
+    dates = np.array([(START_DATE + timedelta(days=day)).isoformat() for day in range(days_count)])
+    rows_count = 0
+    for file_idx in range(files_count):
+        csv_file_path = join(csv_path, 'raw_%d.csv' % file_idx)
+        with open(csv_file_path, 'w') as csv_file:
+            csv_file.write(','.join(CSV_HEADER) + '\n')
+            for station_idx in range(file_idx, len(names), files_count):
+                station_dates = dates[random_state.uniform(size=days_count) >= MISSING_ROWS_SHARE]
+                station_rows = pd.DataFrame({
+                    'STATION': names[station_idx], 'STATION_NAME': 'NAME', 'ELEVATION': 1,
+                    'LATITUDE': latitudes[station_idx], 'LONGITUDE': longitudes[station_idx], 'DATE': station_dates,
+                    'MDPR': 0, 'DAPR': 0, 'SNWD': 0, 'SNOW': 0,
+                    'PRCP': generate_values(random_state, station_dates.shape[0], 0, 30),
+                    'TMAX': generate_values(random_state, station_dates.shape[0], -5, 35),
+                    'TMIN': generate_values(random_state, station_dates.shape[0], -20, 10)}, columns=CSV_HEADER)
+                station_rows.to_csv(csv_file, header=False, index=False)
+                rows_count += station_rows.shape[0]
+    return rows_count
+
+
+def generate_values(random_state, size, low, high):
+    values = np.round(random_state.uniform(low, high, size), 1)
+    values[random_state.uniform(size=size) < MISSING_VALUES_SHARE] = -9999
+    return values
+
+
+def generate_section_files(section_path, stations, sections_count):
+    names, longitudes, latitudes = stations
+    for section in range(1, sections_count + 1):
+        writer = shapefile.Writer(join(section_path, 'section_%d' % section), shapeType=shapefile.POINT)
+        writer.field('STATION', 'C', 40)
+        for station_idx in range(section - 1, len(names), sections_count):
+            writer.point(longitudes[station_idx], latitudes[station_idx])
+            writer.record(names[station_idx])
+        writer.close()
+
+
+def generate_basein_files(basein_path, sections_count, grid_size, random_state):
+    cell_size = AREA_SIZE / grid_size
+    cells_count = 0
+    for section in range(1, sections_count + 1):
+        writer = shapefile.Writer(join(basein_path, 'basein_%d' % section), shapeType=shapefile.POLYGON)
+        writer.field('Intersect', 'C', 2)
+        writer.field('x', 'N', 18, 6)
+        writer.field('y', 'N', 18, 6)
+        masked = random_state.uniform(size=grid_size * grid_size) < MASKED_CELLS_SHARE
+        for cell_idx in range(grid_size * grid_size):
+            x, y = (cell_idx // grid_size) * cell_size, (cell_idx % grid_size) * cell_size
+            writer.poly([[[x, y], [x, y + cell_size], [x + cell_size, y + cell_size], [x + cell_size, y], [x, y]]])
+            writer.record('n' if masked[cell_idx] else 'y', x + cell_size / 2, y + cell_size / 2)
+        writer.close()
+        cells_count += int((~masked).sum())
+    return cells_count
+
+
+def generate_dataset(work_dir, arguments):
+    random_state = np.random.RandomState(arguments.seed)
+    paths = dict((name, join(work_dir, name)) for name in ('csv', 'sections', 'baseins', 'output'))
+    for path in paths.values():
+        clear_dir(path)
+
+    stations = generate_stations(arguments.stations, random_state)
+    days_count = (date(START_DATE.year + arguments.years, 1, 1) - START_DATE).days
+    logging.warning('Generating %d stations, %d days, %d sections with %dx%d grids', arguments.stations, days_count,
+                    arguments.sections, arguments.grid_size, arguments.grid_size)
+    rows_count = generate_raw_csv_files(paths['csv'], stations, days_count, arguments.files, random_state)
+    generate_section_files(paths['sections'], stations, arguments.sections)
+    cells_count = generate_basein_files(paths['baseins'], arguments.sections, arguments.grid_size, random_state)
+    return paths, {'rows': rows_count, 'dates': days_count, 'cells': cells_count}
+
+
+def measure_stage(target, args, results_queue):
+    try:
+        start_time = time.time()
+        value = target(*args)
+        results_queue.put({'seconds': time.time() - start_time, 'peak_rss': get_stage_peak_rss(), 'value': value})
+    except Exception:
+        results_queue.put({'error': traceback.format_exc()})
+
+
+def get_stage_peak_rss():
+    if resource is None:
+        return None
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+
+def run_stage(name, target, args):
+    logging.warning('Running stage %s', name)
+    results_queue = Queue()
+    process = Process(target=measure_stage, args=(target, args, results_queue))
+    process.start()
+    result = results_queue.get()
+    process.join()
+    if 'error' in result:
+        raise Exception('Stage %s failed:\n%s' % (name, result['error']))
+    return result
+
+
+def run_data_frames_stage(data_frames_tasks, workers):
+    run_tasks(data_frames_tasks, workers)
+
+
+def run_daily_stage(daily_tasks, workers):
+    run_tasks(daily_tasks, workers)
+
+
+def run_monthly_stage(monthly_tasks, workers):
+    run_tasks([dict(task_desc, depends_on=[]) for task_desc in monthly_tasks], workers)
+
+
+def run_benchmark(paths, counts, workers):
+    output_path = paths['output']
+    raw_data_path = join(output_path, RAW_DATA_DIR)
+    data_frames_path = join(output_path, DATA_FRAMES_DIR)
+    daily_path = join(output_path, DAILY_RESULTS_DIR)
+    monthly_path = join(output_path, MONTHLY_RESULTS_DIR)
+    for path in (raw_data_path, data_frames_path, daily_path, monthly_path):
+        mkpath(path)
+
+    results = {}
+    check_result = run_stage('check_csv_files_for_right_structure', check_csv_files_for_right_structure,
+                             (paths['csv'], raw_data_path, (), None, workers))
+    results['check_csv_files_for_right_structure'] = get_stage_result(check_result, counts['rows'], 'rows/s')
+
+    station_catalogue = build_station_catalogue(check_result['value'], raw_data_path)
+    shape_file_and_correspondent_stations = get_shape_file_and_correspondent_stations(station_catalogue,
+                                                                                      paths['sections'])
+    data_frames_tasks = get_data_frames_tasks(shape_file_and_correspondent_stations, raw_data_path, data_frames_path,
+                                              NPY_FRAME_FORMAT)
+    results['make_data_frames'] = get_stage_result(
+        run_stage('make_data_frames', run_data_frames_stage, (data_frames_tasks, workers)), counts['rows'], 'rows/s')
+
+    data_files = get_files_for_getting_daily_metrics(paths['baseins'], paths['sections'], data_frames_path,
+                                                     get_frame_extension(NPY_FRAME_FORMAT))
+    daily_tasks = get_daily_tasks(data_files, daily_path)
+    daily_result = run_stage('process_daily', run_daily_stage, (daily_tasks, workers))
+    results['process_daily'] = get_stage_result(daily_result, counts['dates'] * counts['cells'] * 3, 'cells/s')
+    results['process_daily']['dates_per_second'] = counts['dates'] * 3 * len(data_files) / daily_result['seconds']
+    check_stage_outputs('process_daily', [path for task_desc in daily_tasks for path in task_desc['outputs']])
+
+    monthly_tasks = get_monthly_tasks(daily_tasks, monthly_path)
+    results['calculate_monthly_values'] = get_stage_result(
+        run_stage('calculate_monthly_values', run_monthly_stage, (monthly_tasks, workers)),
+        counts['dates'] * len(monthly_tasks), 'dates/s')
+    check_stage_outputs('calculate_monthly_values', [join(monthly_path, basename(task_desc['args'][0]))
+                                                     for task_desc in monthly_tasks])
+    return results
+
+
+def check_stage_outputs(name, outputs_paths):
+    missing_outputs = [path for path in outputs_paths if not exists(path)]
+    if missing_outputs:
+        raise Exception('Stage %s did not create: %s' % (name, ', '.join(missing_outputs)))
+
+
+def get_stage_result(stage_result, items_count, unit):
+    return {'seconds': stage_result['seconds'], 'peak_rss': stage_result['peak_rss'],
+            'throughput': items_count / stage_result['seconds'] if stage_result['seconds'] else None, 'unit': unit}
+
+
+def compare_with_baseline(results, parameters, baseline_path, tolerance):
+    if not exists(baseline_path):
+        logging.warning('Baseline %s not found, nothing to compare with', baseline_path)
+        return {}, []
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    if baseline.get('parameters') != parameters:
+        logging.warning('Baseline %s was recorded with other parameters: %s', baseline_path,
+                        baseline.get('parameters'))
+        return {}, []
+
+    regressions = []
+    for stage, result in sorted(results.items()):
+        baseline_result = baseline['stages'].get(stage)
+        if baseline_result is None:
+            continue
+        if result['seconds'] > baseline_result['seconds'] * (1 + tolerance):
+            regressions.append('%s is slower: %.2f s against %.2f s' % (stage, result['seconds'],
+                                                                       baseline_result['seconds']))
+        if result['peak_rss'] and baseline_result['peak_rss'] and \
+                result['peak_rss'] > baseline_result['peak_rss'] * (1 + tolerance):
+            regressions.append('%s uses more memory: %s against %s' % (
+                stage, format_memory_size(result['peak_rss']), format_memory_size(baseline_result['peak_rss'])))
+    return baseline['stages'], regressions
+
+
+def print_results(results, baseline_stages):
+    row_format = '%-38s %10s %22s %12s %12s'
+    print(row_format % ('stage', 'seconds', 'throughput', 'peak RSS', 'baseline s'))
+    for stage in ('check_csv_files_for_right_structure', 'make_data_frames', 'process_daily',
+                  'calculate_monthly_values'):
+        result = results[stage]
+        baseline_seconds = baseline_stages.get(stage, {}).get('seconds')
+        print(row_format % (stage, '%.2f' % result['seconds'], '%.0f %s' % (result['throughput'], result['unit']),
+                            format_memory_size(result['peak_rss']),
+                            'n/a' if baseline_seconds is None else '%.2f' % baseline_seconds))
+
+
+def dump_results(path, parameters, counts, results):
+    with open(path, 'w') as results_file:
+        json.dump({'parameters': parameters, 'counts': counts, 'stages': results}, results_file, indent=1,
+                  sort_keys=True)
+
+
+def main():
+    arguments = parse_arguments()
+    work_dir = abspath(arguments.work_dir)
+    mkpath(work_dir)
+    configure_logging(join(work_dir, 'benchmark.log'), logging.INFO if arguments.verbose else logging.WARNING)
+
+    parameters = get_parameters(arguments)
+    paths, counts = generate_dataset(work_dir, arguments)
+    results = run_benchmark(paths, counts, arguments.workers or None)
+    dump_results(join(work_dir, RESULTS_FILE_NAME), parameters, counts, results)
+
+    baseline_stages, regressions = compare_with_baseline(results, parameters, arguments.baseline,
+                                                         arguments.tolerance)
+    print_results(results, baseline_stages)
+    if arguments.save_baseline:
+        dump_results(arguments.baseline, parameters, counts, results)
+        logging.warning('Baseline stored in %s', arguments.baseline)
+    if regressions:
+        print('Performance regressions:\n%s' % '\n'.join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,39 @@
+from os.path import splitext
+
+import numpy as np
+import pandas as pd
+
+__all__ = ['FRAME_FORMATS', 'NPY_FRAME_FORMAT', 'CSV_FRAME_FORMAT', 'get_frame_extension', 'dump_data_frame',
+           'load_data_frame']
+
+NPY_FRAME_FORMAT = 'npy'
+CSV_FRAME_FORMAT = 'csv'
+FRAME_FORMATS = {NPY_FRAME_FORMAT: '.npy', CSV_FRAME_FORMAT: '.csv'}
+INDEX_SUFFIX = '.index.npz'
+
+
+def get_frame_extension(frame_format):
+    if frame_format not in FRAME_FORMATS:
+        raise Exception('Unknown data frames format: %s' % frame_format)
+    return FRAME_FORMATS[frame_format]
+
+
+def dump_data_frame(path_base, data_frame, frame_format):
+    path = path_base + get_frame_extension(frame_format)
+    if frame_format == CSV_FRAME_FORMAT:
+        data_frame.to_csv(path)
+    else:
+        np.save(path, np.ascontiguousarray(data_frame.values, dtype=np.float64))
+        np.savez(path_base + INDEX_SUFFIX, dates=data_frame.index.values, stations=np.array(list(data_frame.columns)))
+    return path
+
+
+def load_data_frame(path, in_memory=False):
+    path_base, extension = splitext(path)
+    if extension == FRAME_FORMATS[CSV_FRAME_FORMAT]:
+        return pd.read_csv(path, parse_dates=True, index_col=0)
+
+    values = np.load(path, mmap_mode=None if in_memory else 'r')
+    with np.load(path_base + INDEX_SUFFIX) as index:
+        dates, stations = index['dates'], index['stations'].tolist()
+    return pd.DataFrame(values, index=pd.DatetimeIndex(dates, name='DATE'), columns=stations, copy=False)
@@ -1,29 +1,69 @@
 import logging
 import sys
 from ConfigParser import ConfigParser
-from calendar import monthrange
 from datetime import datetime
 from glob import glob
-from itertools import combinations
-from os.path import join, basename, splitext, dirname
+from functools import partial
+from os.path import join, basename, splitext, dirname, isdir, isfile, getsize, getmtime
 
 import numpy as np
 import pandas as pd
-from scipy.interpolate import griddata
 
+from frame_store import *
+from grid_index import *
+from manifest import *
+from raw_data import *
+from metrics import *
+from prefetch import *
+from report_writer import *
+from station_cache import *
+from station_catalogue import *
 from utils import *
 
 configure_logging(LOG_FILE_NAME)
 
+RAW_DATA_DIR = r'RAW_DATA'
 DATA_FRAMES_DIR = r'DATA_FRAMES'
 DAILY_RESULTS_DIR = r'DAILY'
 MONTHLY_RESULTS_DIR = r'MONTHLY'
+STATE_DIR = r'STATE'
+GRIDS_CACHE_DIR = r'GRIDS'
+PROFILES_DIR = r'PROFILES'
+VALIDATION_FILE_NAME = 'validation.json'
+PROFILE_ALL_TASKS = 'all'
+DATA_FRAMES_SUFFIXES = ('_prcp', '_tmin', '_tmax')
 
+DAILY_REPORT_HEADER = ("date", "area-weighted", "max", "min", "count", "gauge_pairs")
+MONTHLY_REPORT_HEADER = ("datetime", "area-weighted")
 
-def create_weather_reports():
-    logging.info('Start parsing weather data')
+BATCHED_DAILY_MODE = 'batched'
+ROWS_DAILY_MODE = 'rows'
+
+FUSED_MONTHLY_MODE = 'fused'
+STANDALONE_MONTHLY_MODE = 'standalone'
+
+JOINT_DAILY_VARIABLES = 'joint'
+SEPARATE_DAILY_VARIABLES = 'separate'
+
+BASIN_CHUNKS_PER_WORKER = 4
+
+DEFAULT_DAILY_SETTINGS = {'daily_mode': BATCHED_DAILY_MODE, 'state_path': None, 'grids_cache_path': None,
+                          'buffer_size': DEFAULT_BUFFER_SIZE, 'monthly_path': None, 'catalogue_path': None,
+                          'daily_variables': JOINT_DAILY_VARIABLES, 'basin_workers': 1,
+                          'prefetch_depth': DEFAULT_PREFETCH_DEPTH}
+
+_chunk_station_index = None
+
+
+def load_config():
     config = ConfigParser()
     config.read(join(dirname(sys.argv[0]), 'paths.cfg'))
+    return config
+
+
+def create_weather_reports(incremental=None):
+    logging.info('Start parsing weather data')
+    config = load_config()
 
     csv_data_path = config.get('paths', 'csv_data_path')
     section_files_path = config.get('paths', 'section_files_path')
@@ -31,208 +71,785 @@ def create_weather_reports():
 
     output_dir_path = config.get('paths', 'output_dir_path')
 
+    daily_mode = get_config_value(config, 'processing', 'daily_mode', BATCHED_DAILY_MODE)
+    daily_variables = get_config_value(config, 'processing', 'daily_variables', JOINT_DAILY_VARIABLES)
+    if daily_variables not in (JOINT_DAILY_VARIABLES, SEPARATE_DAILY_VARIABLES):
+        raise Exception('Unknown daily variables mode: %s' % daily_variables)
+    basin_workers = int(get_config_value(config, 'processing', 'basin_workers', 1))
+    prefetch_depth = int(get_config_value(config, 'processing', 'prefetch_depth', DEFAULT_PREFETCH_DEPTH))
+    scheduling = {'workers': int(get_config_value(config, 'processing', 'workers', 0)),
+                  'keep_going': get_config_flag(config, 'processing', 'keep_going', False)}
+    if incremental is None:
+        incremental = get_config_flag(config, 'processing', 'incremental', False)
+    frame_format = get_config_value(config, 'processing', 'data_frames_format', NPY_FRAME_FORMAT)
+    frame_extension = get_frame_extension(frame_format)
+    buffer_size = int(get_config_value(config, 'processing', 'write_buffer_size', DEFAULT_BUFFER_SIZE))
+    monthly_mode = get_config_value(config, 'processing', 'monthly_mode', FUSED_MONTHLY_MODE)
+    if monthly_mode not in (FUSED_MONTHLY_MODE, STANDALONE_MONTHLY_MODE):
+        raise Exception('Unknown monthly mode: %s' % monthly_mode)
+    csv_chunk_size = int(get_config_value(config, 'processing', 'csv_chunk_size', DEFAULT_CSV_CHUNK_SIZE))
+    station_matching = get_config_value(config, 'processing', 'station_matching', NAME_STATION_MATCHING)
+    if station_matching not in STATION_MATCHING_MODES:
+        raise Exception('Unknown station matching mode: %s' % station_matching)
+    profile_daily = [name.strip() for name in get_config_value(config, 'processing', 'profile_daily', '').split(',')
+                     if name.strip()]
+
+    state_dir_path = join(output_dir_path, STATE_DIR)
+    raw_data_dir_path = join(output_dir_path, RAW_DATA_DIR)
     data_frames_dir_path = join(output_dir_path, DATA_FRAMES_DIR)
     daily_results_dir_path = join(output_dir_path, DAILY_RESULTS_DIR)
     monthly_results_dir_path = join(output_dir_path, MONTHLY_RESULTS_DIR)
 
-    clear_dir(data_frames_dir_path)
+    prepare_dir = mkpath if incremental else clear_dir
+    prepare_dir(state_dir_path)
+    prepare_dir(raw_data_dir_path)
+    prepare_dir(data_frames_dir_path)
     open(LOG_FILE_NAME, 'w').close()
+    metrics_path = join(output_dir_path, METRICS_FILE_NAME)
+    open(metrics_path, 'w').close()
+
+    manifest_path = join(state_dir_path, MANIFEST_FILE_NAME)
+    manifest = load_manifest(manifest_path) if incremental else {}
+    files_fingerprints = get_csv_files_fingerprints(csv_data_path, manifest) if incremental else {}
+
+    validation_path = join(output_dir_path, VALIDATION_FILE_NAME)
+    csv_files_stamps = get_csv_files_stamps(csv_data_path)
+    csv_station_rows = measure_stage(metrics_path, 'check', check_csv_files_for_right_structure, csv_data_path,
+                                     raw_data_dir_path, get_unchanged_files(files_fingerprints, manifest),
+                                     get_validated_station_rows(csv_files_stamps, load_manifest(validation_path)),
+                                     scheduling['workers'], csv_chunk_size)
+    dump_manifest(validation_path, get_validation_cache(csv_station_rows, csv_files_stamps))
+
+    station_catalogue = build_station_catalogue(csv_station_rows, raw_data_dir_path)
+    dump_station_catalogue(join(raw_data_dir_path, CATALOGUE_FILE_NAME), station_catalogue)
+    location_index = None
+    catalogue_path = None
+    if station_matching == LOCATION_STATION_MATCHING:
+        location_index = StationLocationIndex(station_catalogue)
+        catalogue_path = join(raw_data_dir_path, CATALOGUE_FILE_NAME)
+    shape_file_and_correspondent_stations = get_shape_file_and_correspondent_stations(
+        station_catalogue, section_files_path, location_index)
+    if incremental:
+        data_frames_fingerprints = get_data_frames_fingerprints(shape_file_and_correspondent_stations,
+                                                                files_fingerprints, manifest, frame_format)
+        shape_file_and_correspondent_stations = select_changed_data_frames(
+            shape_file_and_correspondent_stations, data_frames_fingerprints, manifest, data_frames_dir_path,
+            frame_extension)
+    data_frames_tasks = get_data_frames_tasks(shape_file_and_correspondent_stations, raw_data_dir_path,
+                                              data_frames_dir_path, frame_format, prefetch_depth)
+
+    prepare_dir(daily_results_dir_path)
+    prepare_dir(monthly_results_dir_path)
+    fused_monthly_path = monthly_results_dir_path if monthly_mode == FUSED_MONTHLY_MODE else None
+    expected_data_files = get_expected_data_files(data_frames_tasks, frame_extension)
+    data_files = get_files_for_getting_daily_metrics(basein_files_path, section_files_path, data_frames_dir_path,
+                                                     frame_extension, expected_data_files.keys())
+    daily_settings = {'daily_mode': daily_mode, 'state_path': state_dir_path if incremental else None,
+                      'grids_cache_path': join(output_dir_path, GRIDS_CACHE_DIR), 'buffer_size': buffer_size,
+                      'monthly_path': fused_monthly_path, 'catalogue_path': catalogue_path,
+                      'daily_variables': daily_variables, 'basin_workers': basin_workers,
+                      'prefetch_depth': prefetch_depth}
+    daily_tasks = get_daily_tasks(data_files, daily_results_dir_path, daily_settings, expected_data_files)
+    if profile_daily:
+        set_daily_profiles(daily_tasks, profile_daily, join(output_dir_path, PROFILES_DIR))
+
+    monthly_tasks = []
+    if monthly_mode == STANDALONE_MONTHLY_MODE:
+        monthly_tasks = get_monthly_tasks(daily_tasks, monthly_results_dir_path, daily_settings['state_path'],
+                                          buffer_size)
+
+    logging.info('Starting pipeline of %d data frame, %d daily and %d monthly tasks', len(data_frames_tasks),
+                 len(daily_tasks), len(monthly_tasks))
+    try:
+        run_tasks(data_frames_tasks + daily_tasks + monthly_tasks, metrics_path=metrics_path, **scheduling)
+    finally:
+        logging.info('Run summary (metrics in %s):\n%s', metrics_path,
+                     format_metrics_summary(get_metrics_summary(load_metrics(metrics_path))))
+    if incremental:
+        dump_manifest(manifest_path, {'files': files_fingerprints, 'data_frames': data_frames_fingerprints})
+    logging.info('Reports created. You can find them inside output folder: %s', output_dir_path)
 
-    check_csv_files_for_right_structure(csv_data_path)
 
-    shape_file_and_correspondent_stations = get_shape_file_and_correspondent_stations(csv_data_path, section_files_path)
-    run_process_of_making_data_frames(shape_file_and_correspondent_stations, data_frames_dir_path)
+def get_csv_files_fingerprints(csv_data_path, manifest):
+    known_fingerprints = manifest.get('files', {})
+    return dict((csv_file_path, get_file_fingerprint(csv_file_path, known_fingerprints))
+                for csv_file_path in glob(join(csv_data_path, '*.csv')))
+
+
+def get_unchanged_files(files_fingerprints, manifest):
+    known_fingerprints = manifest.get('files', {})
+    return set(file_path for file_path, fingerprint in files_fingerprints.items()
+               if file_path in known_fingerprints and known_fingerprints[file_path]['hash'] == fingerprint['hash'])
+
+
+def get_data_frames_fingerprints(shape_file_and_correspondent_stations, files_fingerprints, manifest, frame_format):
+    known_fingerprints = manifest.get('files', {})
+    data_frames_fingerprints = {}
+    for shape_file, stations_data in shape_file_and_correspondent_stations.items():
+        shape_file_fingerprints = get_shape_file_fingerprint(shape_file, known_fingerprints)
+        files_fingerprints.update(shape_file_fingerprints)
+        fingerprint_values = [frame_format]
+        for file_path in sorted(shape_file_fingerprints.keys()) + sorted(stations_data.keys()):
+            fingerprint_values.extend([file_path, files_fingerprints[file_path]['hash']])
+        for csv_file_path in sorted(stations_data.keys()):
+            fingerprint_values.extend(sorted(stations_data[csv_file_path]))
+        data_frames_fingerprints[shape_file] = get_combined_hash(fingerprint_values)
+    return data_frames_fingerprints
+
+
+def select_changed_data_frames(shape_file_and_correspondent_stations, data_frames_fingerprints, manifest,
+                               data_frames_path, frame_extension):
+    known_fingerprints = manifest.get('data_frames', {})
+    changed = {}
+    for shape_file, stations_data in shape_file_and_correspondent_stations.items():
+        output_base = get_data_frames_output_base(data_frames_path, shape_file)
+        if known_fingerprints.get(shape_file) != data_frames_fingerprints[shape_file] or \
+                not all(isfile(output_base + suffix + frame_extension) for suffix in DATA_FRAMES_SUFFIXES):
+            changed[shape_file] = stations_data
+        else:
+            logging.info('Data frames for %s are up to date', basename(shape_file))
+    return changed
 
-    clear_dir(daily_results_dir_path)
-    data_files = get_files_for_getting_daily_metrics(basein_files_path, section_files_path, data_frames_dir_path)
-    run_processing_daily_metrics(data_files, daily_results_dir_path)
 
-    clear_dir(monthly_results_dir_path)
-    run_processing_monthly_metrics(daily_results_dir_path, monthly_results_dir_path)
-    logging.info('Reports created. You can find them inside output folder: %s', output_dir_path)
+def get_csv_files_stamps(csv_data_path):
+    return dict((csv_file_path, {'size': getsize(csv_file_path), 'mtime': getmtime(csv_file_path)})
+                for csv_file_path in glob(join(csv_data_path, '*.csv')))
 
 
-def check_csv_files_for_right_structure(csv_data_path):
-    logging.info('Checking csv data structure')
-    errors = []
-    required_fields = {"TMAX": 12, "TMIN": 13, "PRCP": 9}
-    csv_stations = []
-    for csv_file_path in glob(join(csv_data_path, '*.csv')):
-        try:
-            csv_file = pd.read_csv(csv_file_path, na_values=-9999,
-                                   parse_dates=["DATE"], usecols=[0, 5, 8, 11, 12])
-
-            stations = set(csv_file.STATION.unique())
-            csv_stations.append((csv_file_path, stations))
-        except ValueError:
-            error_entry = required_fields.keys()
-        else:
-            error_entry = []
-            for field in required_fields.keys():
-                if field not in csv_file.columns:
-                    error_entry.append(field)
-        if error_entry:
-            errors.append((basename(csv_file_path), error_entry))
-    if errors:
-        error_string = ''
-        for file_name, error_entry in errors:
-            error_string += 'Failure on file: %s\n' % file_name
-            for field in error_entry:
-                error_string += '\tfiled:%s should be in %s column\n' % (field, required_fields[field])
-            error_string += '=' * 40 + '\n'
-        raise Exception(error_string)
-
-    intersection_errors = []
-    for (first_file, first_stations), (second_file, second_stations) in combinations(csv_stations, 2):
-        intersection = first_stations & second_stations
-        if intersection:
-            intersection_errors.append('files %s and %s have same stations: %s' % (first_file, second_file,
-                                                                                   ', '.join(intersection)))
-    if intersection_errors:
-        error_string = 'Failure with stations uniqueness:\n%s' % '\n'.join(intersection_errors)
-        raise Exception(error_string)
-    logging.info('Structure check done successfully')
+def get_validated_station_rows(csv_files_stamps, validation_cache):
+    validated_station_rows = {}
+    for file_path, validation in validation_cache.items():
+        if 'station_rows' in validation and \
+                csv_files_stamps.get(file_path) == {'size': validation['size'], 'mtime': validation['mtime']}:
+            validated_station_rows[file_path] = dict((str(station), rows)
+                                                     for station, rows in validation['station_rows'].items())
+    return validated_station_rows
 
 
-def run_process_of_making_data_frames(shape_file_and_correspondent_stations, output_path):
-    logging.info('Starting making data frame tasks')
+def get_validation_cache(csv_station_rows, csv_files_stamps):
+    validation_cache = {}
+    for csv_file_path, station_rows in csv_station_rows:
+        if csv_file_path in csv_files_stamps:
+            validation_cache[csv_file_path] = dict(csv_files_stamps[csv_file_path], station_rows=station_rows)
+    return validation_cache
+
+
+def check_csv_files_for_right_structure(csv_data_path, raw_data_path, unchanged_files=(), validated_station_rows=None,
+                                        workers=None, chunk_size=DEFAULT_CSV_CHUNK_SIZE):
+    logging.info('Checking csv data structure')
+    if not isdir(csv_data_path):
+        raise Exception('csv data folder path not found on path: %s' % csv_data_path)
+    validated_station_rows = validated_station_rows or {}
+    csv_files_paths = glob(join(csv_data_path, '*.csv'))
+
+    validation_results = dict((csv_file_path, (validated_station_rows[csv_file_path], []))
+                              for csv_file_path in csv_files_paths if csv_file_path in validated_station_rows)
+    files_to_validate = [csv_file_path for csv_file_path in csv_files_paths
+                         if csv_file_path not in validated_station_rows]
+    logging.info('Validating %d csv files, %d are known', len(files_to_validate), len(validation_results))
+    add_counter('csv_files', len(csv_files_paths))
+    add_counter('validated_files', len(files_to_validate))
+    if files_to_validate:
+        add_counter('bytes_read', get_files_size(files_to_validate))
+        with timer('validation'):
+            for csv_file_path, station_rows, error_entry in map_tasks(partial(validate_raw_csv, chunk_size=chunk_size),
+                                                                      files_to_validate, workers):
+                validation_results[csv_file_path] = (station_rows, error_entry)
+
+    raise_structure_errors([(basename(csv_file_path), validation_results[csv_file_path][1])
+                            for csv_file_path in csv_files_paths if validation_results[csv_file_path][1]])
+    csv_station_rows = [(csv_file_path, validation_results[csv_file_path][0]) for csv_file_path in csv_files_paths]
+    check_stations_uniqueness(csv_station_rows)
+
+    ingest_raw_data(csv_station_rows, raw_data_path, unchanged_files, workers, chunk_size)
+    logging.info('Structure check done successfully')
+    return csv_station_rows
+
+
+def raise_structure_errors(errors):
+    if not errors:
+        return
+    error_string = ''
+    for file_name, error_entry in errors:
+        error_string += 'Failure on file: %s\n' % file_name
+        for field in error_entry:
+            error_string += '\tfiled:%s should be in %s column\n' % (field, REQUIRED_FIELDS[field])
+        error_string += '=' * 40 + '\n'
+    raise Exception(error_string)
+
+
+def check_stations_uniqueness(csv_stations):
+    station_files = {}
+    same_stations = {}
+    for csv_file_path, stations in csv_stations:
+        for station in stations:
+            if station in station_files:
+                same_stations.setdefault((station_files[station], csv_file_path), []).append(station)
+            else:
+                station_files[station] = csv_file_path
+
+    if same_stations:
+        intersection_errors = ['files %s and %s have same stations: %s' % (first_file, second_file,
+                                                                           ', '.join(sorted(stations)))
+                               for (first_file, second_file), stations in sorted(same_stations.items())]
+        raise Exception('Failure with stations uniqueness:\n%s' % '\n'.join(intersection_errors))
+
+
+def ingest_raw_data(csv_station_rows, raw_data_path, unchanged_files=(), workers=None,
+                    chunk_size=DEFAULT_CSV_CHUNK_SIZE):
+    files_to_ingest = []
+    for csv_file_path, station_rows in csv_station_rows:
+        if csv_file_path in unchanged_files and isdir(get_raw_data_path(raw_data_path, csv_file_path)):
+            logging.info('Raw data of %s is up to date', basename(csv_file_path))
+        else:
+            files_to_ingest.append((csv_file_path, station_rows))
+    if not files_to_ingest:
+        return
+
+    logging.info('Ingesting %d csv files by chunks of %d rows', len(files_to_ingest), chunk_size)
+    add_counter('ingested_files', len(files_to_ingest))
+    add_counter('bytes_read', get_files_size([csv_file_path for csv_file_path, _ in files_to_ingest]))
+    with timer('ingestion'):
+        ingestion_results = map_tasks(partial(ingest_raw_csv, raw_data_path, chunk_size=chunk_size), files_to_ingest,
+                                      workers)
+    raise_structure_errors([(basename(csv_file_path), error_entry) for csv_file_path, error_entry in ingestion_results
+                            if error_entry])
+
+
+def get_data_frames_tasks(shape_file_and_correspondent_stations, raw_data_path, output_path,
+                          frame_format=NPY_FRAME_FORMAT, prefetch_depth=DEFAULT_PREFETCH_DEPTH):
     tasks_desc = []
     for shape_file, stations in shape_file_and_correspondent_stations.items():
-        task_desc = {'target': make_data_frames, 'args': (shape_file, stations, output_path)}
+        output_base = get_data_frames_output_base(output_path, shape_file)
+        task_desc = {'target': make_data_frames, 'args': (shape_file, stations, raw_data_path, output_path,
+                                                          frame_format, prefetch_depth),
+                     'name': 'data frames %s' % basename(shape_file), 'stage': 'data_frames',
+                     'size': get_files_size(stations.keys()),
+                     'outputs': [output_base + suffix for suffix in DATA_FRAMES_SUFFIXES]}
         tasks_desc.append(task_desc)
+    return tasks_desc
+
 
-    run_tasks(tasks_desc)
+def get_expected_data_files(data_frames_tasks, frame_extension):
+    expected_data_files = {}
+    for task_desc in data_frames_tasks:
+        for output_base in task_desc['outputs']:
+            expected_data_files[output_base + frame_extension] = task_desc['name']
+    return expected_data_files
 
 
-def make_data_frames(station_shape_file, stations_data, output_path):
+def make_data_frames(station_shape_file, stations_data, raw_data_path, output_path, frame_format=NPY_FRAME_FORMAT,
+                     prefetch_depth=DEFAULT_PREFETCH_DEPTH):
     logging.info('Making data frame for shapefile: %s', basename(station_shape_file))
     try:
-        prcp, tmax, tmin = aggregate_data_frames(stations_data)
-
-        logging.info("joining {0:d} dataframes".format(len(prcp)))
-        prcp_df, tmax_df, tmin_df = join_data_aggregated_data_frames(prcp, tmax, tmin)
-
-        output_base = join(output_path, basename(station_shape_file).rstrip('.shp'))
-        dump_data_frames(output_base, prcp_df, tmax_df, tmin_df)
+        aligned_rows = aggregate_stations_rows(stations_data, raw_data_path, prefetch_depth)
+        with timer('align'):
+            prcp_df, tmax_df, tmin_df = merge_aligned_rows(aligned_rows)
+        add_counter('dates', prcp_df.shape[0])
+
+        output_base = get_data_frames_output_base(output_path, station_shape_file)
+        with timer('write'):
+            add_counter('bytes_written', get_files_size(dump_data_frames(output_base, prcp_df, tmax_df, tmin_df,
+                                                                         frame_format)))
     except Exception:
         logging.exception('error on %s', basename(station_shape_file))
+        raise
+
+
+def aggregate_stations_rows(stations_data, raw_data_path, prefetch_depth=DEFAULT_PREFETCH_DEPTH):
+    aligned_rows = []
+    load = partial(read_stations_rows, raw_data_path, in_memory=prefetch_depth > 0)
+    for (csv_file_path, _), stations_rows in prefetch(load, sorted(stations_data.items()), prefetch_depth):
+        if not stations_rows:
+            continue
+        logging.info("aligning {0:d} stations of file: {1:s}".format(len(stations_rows), basename(csv_file_path)))
+        with timer('align'):
+            aligned_rows.append(align_stations_rows(stations_rows))
+        add_counter('stations', len(stations_rows))
+        add_counter('rows', sum(rows.stop - rows.start for _, _, rows in stations_rows))
+    return aligned_rows
+
+
+def read_stations_rows(raw_data_path, csv_file_stations, in_memory=False):
+    csv_file_path, stations = csv_file_stations
+    logging.info('Reading raw data of file: %s', csv_file_path)
+    raw_data = load_raw_data(raw_data_path, csv_file_path)
+    stations_rows = []
+    for station, rows in get_station_slices(raw_data):
+        if station in stations:
+            logging.info("--processing station: " + station)
+            if in_memory:
+                station_data = dict((name, np.array(raw_data[name][rows]))
+                                    for name in ('date',) + tuple(field.lower() for field in VALUE_FIELDS))
+                stations_rows.append((station, station_data, slice(0, rows.stop - rows.start)))
+            else:
+                stations_rows.append((station, raw_data, rows))
+    return stations_rows
+
+
+def align_stations_rows(stations_rows):
+    dates = np.unique(np.concatenate([raw_data['date'][rows] for _, raw_data, rows in stations_rows]))
+    values = dict((field, np.full((dates.shape[0], len(stations_rows)), np.NaN)) for field in VALUE_FIELDS)
+    for column, (_, raw_data, rows) in enumerate(stations_rows):
+        positions = np.searchsorted(dates, raw_data['date'][rows])
+        for field in VALUE_FIELDS:
+            values[field][positions, column] = raw_data[field.lower()][rows]
+    return [station for station, _, _ in stations_rows], dates, values
+
+
+def merge_aligned_rows(aligned_rows):
+    if not aligned_rows:
+        raise Exception('No stations data to align')
+
+    if len(aligned_rows) == 1:
+        columns, dates, values = aligned_rows[0]
+    else:
+        columns = [station for file_columns, _, _ in aligned_rows for station in file_columns]
+        dates = np.unique(np.concatenate([file_dates for _, file_dates, _ in aligned_rows]))
+        values = dict((field, np.full((dates.shape[0], len(columns)), np.NaN)) for field in VALUE_FIELDS)
+        first_column = 0
+        for file_columns, file_dates, file_values in aligned_rows:
+            positions = np.searchsorted(dates, file_dates)
+            file_slice = slice(first_column, first_column + len(file_columns))
+            for field in VALUE_FIELDS:
+                values[field][positions, file_slice] = file_values[field]
+            first_column = file_slice.stop
 
-
-def aggregate_data_frames(stations_data):
-    prcp, tmin, tmax = [], [], []
-    for csv_file_path, stations in stations_data.items():
-        logging.info('Reading file: %s', csv_file_path)
-        try:
-            csv_file = pd.read_csv(csv_file_path, na_values=-9999,
-                                   parse_dates=["DATE"], usecols=[0, 5, 8, 11, 12])
-        except ValueError:
-            logging.exception('Failed to parse file: %s', csv_file_path)
-        else:
-            for group_info in csv_file.groupby("STATION").groups.items():
-                station, _ = group_info
-                if station in stations:
-                    logging.info("--processing station: " + station)
-                    prcp.append(get_specific_data_frame_for_group(csv_file, group_info, "PRCP"))
-                    tmin.append(get_specific_data_frame_for_group(csv_file, group_info, "TMIN"))
-                    tmax.append(get_specific_data_frame_for_group(csv_file, group_info, "TMAX"))
-    return prcp, tmax, tmin
-
-
-def get_specific_data_frame_for_group(global_data_frame, group_info, data_name):
-    group_id, indexes = group_info
-    data_frame = global_data_frame.loc[indexes, ["DATE", data_name]]
-    data_frame[group_id] = data_frame.pop(data_name)
-    data_frame.index = data_frame.pop("DATE")
-    return data_frame
-
-
-def join_data_aggregated_data_frames(prcp, tmax, tmin):
-    prcp_df = join_data_frames(prcp)
-    tmin_df = join_data_frames(tmin)
-    tmax_df = join_data_frames(tmax)
-    return prcp_df, tmax_df, tmin_df
+    index = pd.DatetimeIndex(dates, name="DATE")
+    return tuple(pd.DataFrame(values[field], index=index, columns=columns) for field in ("PRCP", "TMAX", "TMIN"))
 
 
-def join_data_frames(data_frames):
-    result_df = data_frames[0]
-    for df in data_frames[1:]:
-        result_df = result_df.merge(df, how="outer", left_index=True, right_index=True)
-    return result_df
+def get_data_frames_output_base(output_path, station_shape_file):
+    return join(output_path, basename(station_shape_file).rstrip('.shp'))
 
 
-def dump_data_frames(output_base, prcp_df, tmax_df, tmin_df):
-    prcp_df.to_csv(output_base + '_prcp.csv')
-    tmin_df.to_csv(output_base + '_tmin.csv')
-    tmax_df.to_csv(output_base + '_tmax.csv')
+def dump_data_frames(output_base, prcp_df, tmax_df, tmin_df, frame_format=NPY_FRAME_FORMAT):
+    return [dump_data_frame(output_base + '_prcp', prcp_df, frame_format),
+            dump_data_frame(output_base + '_tmin', tmin_df, frame_format),
+            dump_data_frame(output_base + '_tmax', tmax_df, frame_format)]
 
 
-def run_processing_daily_metrics(data_files, output_path):
-    logging.info('Start processing daily')
+def get_daily_tasks(data_files, output_path, daily_settings=None, expected_data_files=None):
+    daily_settings = dict(DEFAULT_DAILY_SETTINGS, **(daily_settings or {}))
+    if daily_settings['daily_mode'] not in (BATCHED_DAILY_MODE, ROWS_DAILY_MODE):
+        raise Exception('Unknown daily mode: %s' % daily_settings['daily_mode'])
+    expected_data_files = expected_data_files or {}
     tasks_desc = []
     for basein_file_path, section_file_path, csv_files_paths in data_files:
-        task_desc = {'target': process_daily, 'args': (basein_file_path, section_file_path,
-                                                       csv_files_paths, output_path)}
+        depends_on = sorted(set(expected_data_files[csv_file_path] for csv_file_path in csv_files_paths
+                                if csv_file_path in expected_data_files))
+        task_desc = {'target': process_daily, 'args': (basein_file_path, section_file_path, csv_files_paths,
+                                                       output_path, daily_settings),
+                     'basein_file_path': basein_file_path,
+                     'name': 'daily %s' % basename(basein_file_path), 'stage': 'daily', 'depends_on': depends_on,
+                     'size': get_files_size(csv_files_paths),
+                     'outputs': [get_daily_output_path(output_path, csv_file_path)
+                                 for csv_file_path in csv_files_paths]}
         tasks_desc.append(task_desc)
+    return tasks_desc
+
+
+def set_daily_profiles(daily_tasks, profile_daily, profiles_path):
+    mkpath(profiles_path)
+    for task_desc in daily_tasks:
+        basein_file_name = basename(task_desc['basein_file_path'])
+        if PROFILE_ALL_TASKS in profile_daily or basein_file_name in profile_daily:
+            task_desc['profile_path'] = join(profiles_path, splitext(basein_file_name)[0] + '.prof')
+
 
-    run_tasks(tasks_desc)
+def get_daily_output_path(output_path, csv_file_path):
+    return join(output_path, splitext(basename(csv_file_path))[0] + '_processed.csv')
 
 
-def process_daily(basein_file_path, section_file_path, csv_files_paths, output_path):
+def process_daily(basein_file_path, section_file_path, csv_files_paths, output_path, daily_settings=None):
     logging.info('Process daily for %s', basename(basein_file_path))
+    daily_settings = dict(DEFAULT_DAILY_SETTINGS, **(daily_settings or {}))
     try:
-        x, y, masks_array = load_basein_file(basein_file_path)
-        section_stations = load_section_file(section_file_path)
-
-        for csv_file_path in csv_files_paths:
-            logging.info('Processing %s', basename(csv_file_path))
-            csv_file = pd.read_csv(csv_file_path, parse_dates=True, index_col=0)
-            output_file_name = splitext(basename(csv_file_path))[0] + '_processed.csv'
-            output_file_path = join(output_path, output_file_name)
-
-            with open(output_file_path, 'w', 0) as output_file:
-                output_file.write(','.join(("date", "area-weighted", "max", "min", "count", "gauge_pairs")) + '\n')
-
-                for date in csv_file.index:
-                    points, stations, values = prepare_data_raw_data(csv_file, date, section_stations)
-
-                    count = len(values)
-                    if len(values) == 0:
-                        awa = np.NaN
-                        upr = np.NaN
-                        lwr = np.NaN
-                    else:
-                        values = np.array(values)
-                        points = np.array(points)
-                        if not np.all(values == values[0]):
-                            grid = griddata(points, values, (x, y), method="nearest")
-                            grid = np.ma.masked_where(masks_array == 0, grid)
-                            contrib = []
-                            unique_vals = np.unique(grid)
-                            count = 0
-                            for station, value in zip(stations, values):
-                                if value in unique_vals:
-                                    mask = np.zeros_like(grid)
-                                    mask = np.ma.masked_where(masks_array == 0, mask)
-                                    mask[np.where(grid == value)] = 1
-                                    unique_vals_count = np.sum(mask)
-                                    contrib.append(unique_vals_count / masks_array.sum())
-                                    count += 1
-                            awa = grid.mean()
-                            upr = max(unique_vals)
-                            lwr = min(unique_vals)
-                            values = contrib
-                        else:
-                            awa = values[0]
-                            upr = values[0]
-                            lwr = values[0]
-
-                    line = "{0:s},{1:E},{2:E},{3:E},{4:d},".format(str(date), float(awa), float(upr), float(lwr), count)
-                    for site, val in zip(stations, values):
-                        line += ' ' + site + "|{0:E}".format(val)
-                    line += '\n'
-                    output_file.write(line)
+        catalogue_path = daily_settings['catalogue_path']
+        station_catalogue = load_station_catalogue(catalogue_path) if catalogue_path else None
+        section_stations = station_index = None
+        joint_pass = is_joint_daily_pass(daily_settings)
+        daily_jobs = []
+        prefetch_depth = get_daily_prefetch_depth(daily_settings)
+        load = partial(load_data_frame, in_memory=prefetch_depth > 0)
+        for csv_file_path, csv_file in prefetch(load, csv_files_paths, prefetch_depth):
+            daily_job = prepare_daily_job(basein_file_path, section_file_path, csv_file_path, csv_file, output_path,
+                                          daily_settings, station_catalogue)
+            if daily_job is None:
+                continue
+            if station_index is None:
+                with timer('read'):
+                    section_stations = load_section_stations(section_file_path, daily_job['csv_file'].columns,
+                                                             station_catalogue)
+                    station_index = load_station_index(basein_file_path, daily_settings['grids_cache_path'],
+                                                       section_stations)
+            add_counter('dates', daily_job['csv_file'].shape[0])
+            add_counter('cells', daily_job['csv_file'].shape[0] * station_index.cells_count)
+
+            if daily_jobs and list(daily_jobs[-1]['csv_file'].columns) != list(daily_job['csv_file'].columns):
+                process_daily_jobs(daily_jobs, section_stations, station_index, daily_settings)
+                daily_jobs = []
+            daily_jobs.append(daily_job)
+            if not joint_pass:
+                process_daily_jobs(daily_jobs, section_stations, station_index, daily_settings)
+                daily_jobs = []
+        if station_index is None:
+            return
+        if daily_jobs:
+            process_daily_jobs(daily_jobs, section_stations, station_index, daily_settings)
+        logging.info('Nearest station assignments cached for %d station sets', station_index.cache_size())
+        publish_station_index(basein_file_path, station_index)
     except Exception:
         logging.exception('Error occurred on processing daily')
+        raise
+
+
+def prepare_daily_job(basein_file_path, section_file_path, csv_file_path, csv_file, output_path, daily_settings,
+                      station_catalogue):
+    logging.info('Processing %s', basename(csv_file_path))
+    state_path = daily_settings['state_path']
+    add_counter('bytes_read', get_files_size([csv_file_path]))
+    output_file_path = get_daily_output_path(output_path, csv_file_path)
+    daily_job = {'csv_file': csv_file, 'output_file_path': output_file_path, 'since': None}
+    if not state_path:
+        return daily_job
+
+    state_file_path = get_state_path(state_path, output_file_path)
+    state = load_manifest(state_file_path)
+    new_state = get_daily_state(csv_file, basein_file_path, section_file_path, daily_settings['daily_mode'], state,
+                                station_catalogue)
+    needs_update, since = get_daily_changes_start(state, new_state, output_file_path)
+    if not needs_update and daily_settings['monthly_path'] and state.get('monthly_since', '') is not None:
+        needs_update = True
+        since = pd.Timestamp(state['monthly_since']) if state.get('monthly_since') else None
+    if not needs_update:
+        logging.info('Daily report %s is up to date', basename(output_file_path))
+        return None
+    if since is not None:
+        logging.info('Updating daily report %s from %s', basename(output_file_path), since)
+        daily_job['csv_file'] = csv_file[csv_file.index >= since]
+    daily_job.update({'since': since, 'state': state, 'new_state': new_state, 'state_file_path': state_file_path})
+    return daily_job
+
+
+def is_joint_daily_pass(daily_settings):
+    return daily_settings['daily_mode'] == BATCHED_DAILY_MODE and \
+        daily_settings['daily_variables'] == JOINT_DAILY_VARIABLES
+
+
+def get_daily_prefetch_depth(daily_settings):
+    if is_joint_daily_pass(daily_settings) and not daily_settings['state_path']:
+        return 0
+    return daily_settings['prefetch_depth']
+
+
+def process_daily_jobs(daily_jobs, section_stations, station_index, daily_settings):
+    if daily_settings['daily_mode'] == BATCHED_DAILY_MODE:
+        with timer('interpolation'):
+            compute_daily_jobs(daily_jobs, station_index, daily_settings['basin_workers'])
+    for daily_job in daily_jobs:
+        write_daily_job(daily_job, section_stations, station_index, daily_settings)
+
+
+def compute_daily_jobs(daily_jobs, station_index, basin_workers=1):
+    if len(daily_jobs) > 1:
+        logging.info('Processing %s in one pass', ', '.join(basename(job['output_file_path']) for job in daily_jobs))
+    for daily_job, daily_values in zip(daily_jobs, compute_daily_batched([job['csv_file'] for job in daily_jobs],
+                                                                         station_index, basin_workers)):
+        daily_job['daily_values'] = daily_values
+
+
+def write_daily_job(daily_job, section_stations, station_index, daily_settings):
+    daily_mode, buffer_size, monthly_path = (daily_settings['daily_mode'], daily_settings['buffer_size'],
+                                             daily_settings['monthly_path'])
+    output_file_path, since = daily_job['output_file_path'], daily_job['since']
+    keep_before = None if since is None else str(since)
+    monthly_values = MonthlyAccumulator(is_sum_report(output_file_path)) if monthly_path else None
+    add_lines = monthly_values.add_lines if monthly_values is not None and daily_mode != BATCHED_DAILY_MODE else None
+    with ReportWriter(output_file_path, DAILY_REPORT_HEADER, buffer_size, keep_before, add_lines) as writer:
+        if daily_mode == BATCHED_DAILY_MODE:
+            add_values = None
+            if monthly_values is not None:
+                add_values = partial(monthly_values.add_formatted_values, get_months(daily_job['csv_file'].index))
+            writer.write_chunks(format_daily_lines_batched(*daily_job['daily_values'], observer=add_values))
+        else:
+            writer.write_lines(generate_daily_lines(daily_job['csv_file'], section_stations, station_index))
+
+    if monthly_values is not None:
+        write_monthly_values(join(monthly_path, basename(output_file_path)), monthly_values.to_data_frame(),
+                             None if since is None else str(since.date()), buffer_size)
+
+    if daily_settings['state_path']:
+        new_state = daily_job['new_state']
+        if monthly_values is not None:
+            new_state['monthly_since'] = None
+        else:
+            new_state['monthly_since'] = merge_changes_start(daily_job['state'].get('monthly_since', ''), since)
+        dump_manifest(daily_job['state_file_path'], new_state)
+
+
+def load_section_stations(section_file_path, stations, station_catalogue=None):
+    section_stations = load_section_file(section_file_path)
+    if station_catalogue is None:
+        return section_stations
+    catalogue_coordinates = get_catalogue_coordinates(station_catalogue, stations)
+    catalogue_coordinates.update(section_stations)
+    return catalogue_coordinates
+
+
+def get_daily_state(csv_file, basein_file_path, section_file_path, daily_mode, state, station_catalogue=None):
+    known_fingerprints = state.get('files', {})
+    files_fingerprints = get_shape_file_fingerprint(basein_file_path, known_fingerprints)
+    files_fingerprints.update(get_shape_file_fingerprint(section_file_path, known_fingerprints))
+
+    inputs = [daily_mode] + list(csv_file.columns)
+    if station_catalogue is not None:
+        catalogue_coordinates = get_catalogue_coordinates(station_catalogue, csv_file.columns)
+        inputs.extend(catalogue_coordinates.get(station) for station in csv_file.columns)
+    for file_path in sorted(files_fingerprints.keys()):
+        inputs.extend([file_path, files_fingerprints[file_path]['hash']])
+
+    return {'files': files_fingerprints, 'inputs': get_combined_hash(inputs),
+            'years': get_yearly_fingerprints(csv_file), 'monthly_since': state.get('monthly_since', '')}
+
+
+def get_daily_changes_start(state, new_state, output_file_path):
+    if not isfile(output_file_path) or state.get('inputs') != new_state['inputs']:
+        return True, None
+
+    known_years = state.get('years', {})
+    if any(year not in new_state['years'] for year in known_years):
+        return True, None
+    changed_years = [int(year) for year, fingerprint in new_state['years'].items()
+                     if known_years.get(year) != fingerprint]
+    if not changed_years:
+        return False, None
+    return True, pd.Timestamp(datetime(min(changed_years), 1, 1))
+
+
+def is_sum_report(output_file_path):
+    return "_prcp_" in basename(output_file_path).lower()
+
+
+def write_monthly_values(output_file_path, monthly_values, since, buffer_size=DEFAULT_BUFFER_SIZE):
+    with ReportWriter(output_file_path, MONTHLY_REPORT_HEADER, buffer_size, since) as writer:
+        if not monthly_values.empty:
+            writer.write_lines([monthly_values.to_csv(header=False, line_terminator='\n')])
+
+
+def write_monthly_report(output_file_path, daily_data_frames, since, buffer_size=DEFAULT_BUFFER_SIZE):
+    use_sum = is_sum_report(output_file_path)
+    with ReportWriter(output_file_path, MONTHLY_REPORT_HEADER, buffer_size, since) as writer:
+        for daily_data_frame in daily_data_frames:
+            if since:
+                daily_data_frame = daily_data_frame[daily_data_frame.index >= since]
+            if not daily_data_frame.empty:
+                groups = aggregate_monthly_values(daily_data_frame, use_sum)
+                writer.write_lines([groups.to_csv(header=False, line_terminator='\n')])
+
+
+def aggregate_monthly_values(daily_data_frame, use_sum):
+    months = daily_data_frame.resample('M')
+    groups = months.sum() if use_sum else months.mean()
+    groups = groups[months.size() > 0]
+    groups.index = groups.index + pd.Timedelta(hours=23, minutes=59, seconds=59)
+    return groups
+
+
+def get_months(dates):
+    return np.asarray(dates.year, dtype=np.int64) * 12 + np.asarray(dates.month, dtype=np.int64) - 1
+
+
+class MonthlyAccumulator(object):
+    def __init__(self, use_sum):
+        self.use_sum = use_sum
+        self.months = []
+        self.totals = []
+        self.counts = []
+
+    def add_values(self, months, values):
+        if not len(months):
+            return
+        unique_months, labels = np.unique(months, return_inverse=True)
+        reported = ~np.isnan(values)
+        labels, values = labels[reported], values[reported]
+        counts = np.bincount(labels, minlength=unique_months.shape[0])
+        if self.months and self.months[-1] == unique_months[0]:
+            self.months.pop()
+            counts[0] += self.counts.pop()
+            labels = np.concatenate(([0], labels))
+            values = np.concatenate(([self.totals.pop()], values))
+        totals = np.bincount(labels, weights=values, minlength=unique_months.shape[0])
+        self.months.extend(unique_months.tolist())
+        self.totals.extend(totals.tolist())
+        self.counts.extend(counts.tolist())
+
+    def add_formatted_values(self, months, rows, values_strings):
+        self.add_values(months[rows], values_strings.astype(np.float64))
+
+    def add_lines(self, lines):
+        dates, values = zip(*[line.split(',', 2)[:2] for line in lines]) if lines else ((), ())
+        self.add_values(np.array([int(date[:4]) * 12 + int(date[5:7]) - 1 for date in dates], dtype=np.int64),
+                        np.array(values, dtype=np.float64))
+
+    def to_data_frame(self):
+        totals = np.array(self.totals, dtype=np.float64)
+        counts = np.array(self.counts, dtype=np.float64)
+        if not self.use_sum:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                totals = totals / counts
+        index = pd.to_datetime(['%04d-%02d-01' % (month // 12, month % 12 + 1) for month in self.months])
+        index = index + pd.offsets.MonthEnd(0) + pd.Timedelta(hours=23, minutes=59, seconds=59)
+        return pd.DataFrame({"area-weighted": totals}, index=index)
+
+
+def read_daily_report_by_months(data_file_path, chunk_size=DEFAULT_CHUNK_SIZE):
+    carry = None
+    for chunk in pd.read_csv(data_file_path, parse_dates=True, index_col=0, usecols=["date", "area-weighted"],
+                             na_values=["NAN"], float_precision='round_trip', chunksize=chunk_size):
+        if carry is not None:
+            chunk = pd.concat([carry, chunk])
+        add_counter('dates', chunk.shape[0] - (0 if carry is None else carry.shape[0]))
+        last_month = (chunk.index.year == chunk.index[-1].year) & (chunk.index.month == chunk.index[-1].month)
+        carry = chunk[last_month]
+        yield chunk[~last_month]
+    if carry is not None:
+        yield carry
+
+
+def merge_changes_start(pending_since, since):
+    if since is None or pending_since == '':
+        return ''
+    if pending_since is None:
+        return str(since.date())
+    return min(pending_since, str(since.date()))
+
+
+def generate_daily_lines(csv_file, section_stations, station_index):
+    for date in csv_file.index:
+        points, stations, values = prepare_data_raw_data(csv_file, date, section_stations)
+
+        count = len(values)
+        if len(values) == 0:
+            awa = np.NaN
+            upr = np.NaN
+            lwr = np.NaN
+        else:
+            values = np.array(values)
+            if not np.all(values == values[0]):
+                with timer('interpolation'):
+                    awa, upr, lwr, stations, values = station_index.reduce(stations, values)
+                count = len(stations)
+            else:
+                awa = values[0]
+                upr = values[0]
+                lwr = values[0]
+
+        yield format_daily_line(str(date), awa, upr, lwr, count, format_gauge_pairs(stations, values))
+
+
+def compute_daily_batched(csv_files, station_index, basin_workers=1):
+    columns = csv_files[0].columns
+    data = np.vstack([np.asarray(csv_file.values, dtype=np.float64) for csv_file in csv_files])
+    if basin_workers > 1 and data.shape[0] > 1:
+        awa, upr, lwr, counts, gauge_pairs = compute_daily_values_parallel(columns, data, station_index,
+                                                                           basin_workers)
+    else:
+        awa, upr, lwr, counts, gauge_pairs = compute_daily_values(columns, data, station_index)
+
+    daily_values = []
+    start = 0
+    for csv_file in csv_files:
+        stop = start + csv_file.shape[0]
+        dates = [str(date) for date in csv_file.index]
+        daily_values.append((dates, awa[start:stop], upr[start:stop], lwr[start:stop], counts[start:stop],
+                             gauge_pairs[start:stop]))
+        start = stop
+    return daily_values
+
+
+def compute_daily_values(columns, data, station_index):
+    reported = ~np.isnan(data)
+    rows_count = data.shape[0]
+
+    awa = np.full(rows_count, np.NaN)
+    upr = np.full(rows_count, np.NaN)
+    lwr = np.full(rows_count, np.NaN)
+    counts = reported.sum(axis=1)
+    gauge_pairs = [''] * rows_count
+
+    if rows_count:
+        patterns, pattern_labels = np.unique(reported, axis=0, return_inverse=True)
+        order = np.argsort(pattern_labels, kind='mergesort')
+        bounds = np.cumsum(np.bincount(pattern_labels, minlength=patterns.shape[0]))
+        for pattern, rows in zip(patterns, np.split(order, bounds[:-1])):
+            process_daily_group(columns, data, pattern, rows, station_index, awa, upr, lwr, counts, gauge_pairs)
+    return awa, upr, lwr, counts, gauge_pairs
+
+
+def compute_daily_values_parallel(columns, data, station_index, workers):
+    chunk_size = -(-data.shape[0] // (workers * BASIN_CHUNKS_PER_WORKER))
+    chunks = [(columns, data[start:start + chunk_size]) for start in range(0, data.shape[0], chunk_size)]
+    logging.info('Computing %d dates in %d chunks on %d workers', data.shape[0], len(chunks), workers)
+    chunks_values = map_tasks(compute_daily_chunk, chunks, workers, init_daily_chunk_worker,
+                              (share_grid_cells(station_index.cells), station_index.section_stations))
+    awa, upr, lwr, counts = [np.concatenate([chunk_values[idx] for chunk_values in chunks_values])
+                             for idx in range(4)]
+    gauge_pairs = [pairs for chunk_values in chunks_values for pairs in chunk_values[4]]
+    return awa, upr, lwr, counts, gauge_pairs
+
+
+def init_daily_chunk_worker(shared_cells, section_stations):
+    global _chunk_station_index
+    _chunk_station_index = NearestStationIndex(load_shared_grid_cells(shared_cells), section_stations)
+
+
+def compute_daily_chunk(chunk):
+    columns, data = chunk
+    return compute_daily_values(columns, data, _chunk_station_index)
+
+
+def format_daily_lines_batched(dates, awa, upr, lwr, counts, gauge_pairs, chunk_size=DEFAULT_CHUNK_SIZE,
+                               observer=None):
+    for start in range(0, len(dates), chunk_size):
+        stop = start + chunk_size
+        awa_strings, upr_strings, lwr_strings = [np.char.mod('%E', column[start:stop]) for column in (awa, upr, lwr)]
+        if observer is not None:
+            observer(slice(start, stop), awa_strings)
+        counts_strings = np.char.mod('%d', counts[start:stop])
+        yield [','.join(row) + '\n' for row in zip(dates[start:stop], awa_strings, upr_strings, lwr_strings,
+                                                    counts_strings, gauge_pairs[start:stop])]
+
+
+def process_daily_group(columns, data, pattern, rows, station_index, awa, upr, lwr, counts, gauge_pairs):
+    columns_idx = np.nonzero(pattern)[0]
+    if columns_idx.shape[0] == 0:
+        return
+
+    values = data[np.ix_(rows, columns_idx)]
+    stations = list(columns[columns_idx])
+    uniform = np.all(values == values[:, :1], axis=1)
+    awa[rows] = upr[rows] = lwr[rows] = values[:, 0]
+    if columns_idx.shape[0] > 1:
+        for row, row_values in zip(rows[uniform], values[uniform]):
+            gauge_pairs[row] = format_gauge_pairs(stations, row_values)
+
+    if not np.all(uniform):
+        rows = rows[~uniform]
+        awa[rows], upr[rows], lwr[rows], owner_stations, contrib = station_index.reduce(stations, values[~uniform])
+        counts[rows] = len(owner_stations)
+        pairs = format_gauge_pairs(owner_stations, contrib)
+        for row in rows:
+            gauge_pairs[row] = pairs
+
+
+def format_daily_line(date, awa, upr, lwr, count, gauge_pairs):
+    return "{0:s},{1:E},{2:E},{3:E},{4:d},{5:s}\n".format(date, float(awa), float(upr), float(lwr), int(count),
+                                                          gauge_pairs)
+
+
+def format_gauge_pairs(stations, values):
+    return ''.join([" {0:s}|{1:E}".format(site, val) for site, val in zip(stations, values)])
 
 
 def prepare_data_raw_data(csv_file, date, section_stations):
@@ -253,31 +870,40 @@ def prepare_data_raw_data(csv_file, date, section_stations):
     return points, stations, values
 
 
-def run_processing_monthly_metrics(data_files_path, output_path):
+def get_monthly_tasks(daily_tasks, output_path, state_path=None, buffer_size=DEFAULT_BUFFER_SIZE):
     tasks_desc = []
-    for file_path in glob(join(data_files_path, '*.csv')):
-        task_desc = {'target': calculate_monthly_values, 'args': (file_path, output_path)}
-        tasks_desc.append(task_desc)
-
-    run_tasks(tasks_desc)
-
-
-def calculate_monthly_values(data_file_path, output_path):
+    for daily_task_desc in daily_tasks:
+        for file_path in daily_task_desc['outputs']:
+            task_desc = {'target': calculate_monthly_values, 'args': (file_path, output_path, state_path,
+                                                                      buffer_size),
+                         'name': 'monthly %s' % basename(file_path), 'stage': 'monthly',
+                         'depends_on': [daily_task_desc['name']],
+                         'size': daily_task_desc['size']}
+            tasks_desc.append(task_desc)
+    return tasks_desc
+
+
+def get_monthly_changes_start(data_file_path, output_path, state_path):
+    if not state_path or not isfile(join(output_path, basename(data_file_path))):
+        return ''
+    return load_manifest(get_state_path(state_path, data_file_path)).get('monthly_since', '')
+
+
+def calculate_monthly_values(data_file_path, output_path, state_path=None, buffer_size=DEFAULT_BUFFER_SIZE):
+    since = get_monthly_changes_start(data_file_path, output_path, state_path)
+    if since is None:
+        logging.info('Monthly report %s is up to date', basename(data_file_path))
+        return
     logging.info('Calculating monthly metrics for file: %s', data_file_path)
-    daily_data_frame = pd.read_csv(data_file_path, parse_dates=True, index_col=0,
-                                   usecols=["date", "area-weighted"], na_values=["NAN"])
-
-    if "_prcp_" in data_file_path.lower():
-        groups = daily_data_frame.groupby([lambda x: x.year, lambda x: x.month]).sum()
-    else:
-        groups = daily_data_frame.groupby([lambda x: x.year, lambda x: x.month]).mean()
+    add_counter('bytes_read', get_files_size([data_file_path]))
+    output_file_path = join(output_path, basename(data_file_path))
+    write_monthly_report(output_file_path, read_daily_report_by_months(data_file_path), since or None, buffer_size)
 
-    datetimes_collection = []
-    for year, month in groups.index:
-        datetimes_collection.append(datetime(year=year, month=month, day=monthrange(year, month)[1],
-                                             hour=23, minute=59, second=59))
-    groups.index = datetimes_collection
-    groups.to_csv(join(output_path, basename(data_file_path)), index_label="datetime")
+    if state_path:
+        state_file_path = get_state_path(state_path, data_file_path)
+        state = load_manifest(state_file_path)
+        state['monthly_since'] = None
+        dump_manifest(state_file_path, state)
 
 
 if __name__ == '__main__':
@@ -285,3 +911,4 @@ if __name__ == '__main__':
         create_weather_reports()
     except Exception as e:
         logging.exception('Error on executing main function')
+        sys.exit(1)
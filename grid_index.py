@@ -0,0 +1,55 @@
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+__all__ = ['NearestStationIndex', 'get_grid_cells', 'share_grid_cells', 'load_shared_grid_cells']
+
+
+def get_grid_cells(x, y, masks_array):
+    cells_mask = masks_array != 0
+    return np.column_stack((x[cells_mask], y[cells_mask]))
+
+
+def share_grid_cells(cells):
+    shared_cells = RawArray('d', cells.size)
+    load_shared_grid_cells(shared_cells)[:] = cells
+    return shared_cells
+
+
+def load_shared_grid_cells(shared_cells):
+    return np.frombuffer(shared_cells, dtype=np.float64).reshape(-1, 2)
+
+
+class NearestStationIndex(object):
+    def __init__(self, cells, section_stations):
+        self.cells = cells
+        self.cells_count = self.cells.shape[0]
+        self.section_stations = section_stations
+        self._cells_per_station = {}
+
+    def cells_per_station(self, stations):
+        key = tuple(stations)
+        if key not in self._cells_per_station:
+            points = np.array([self.section_stations[station] for station in stations])
+            _, labels = cKDTree(points).query(self.cells)
+            self._cells_per_station[key] = np.bincount(labels, minlength=len(stations))
+        return self._cells_per_station[key]
+
+    def reduce(self, stations, values):
+        cells_per_station = self.cells_per_station(stations)
+        owners = cells_per_station > 0
+        owner_values = values[..., owners]
+        awa = (values * cells_per_station).sum(axis=-1) / float(self.cells_count)
+        contrib = cells_per_station[owners] / float(self.cells_count)
+        owner_stations = [station for station, owner in zip(stations, owners) if owner]
+        return awa, owner_values.max(axis=-1), owner_values.min(axis=-1), owner_stations, contrib
+
+    def cache_size(self):
+        return len(self._cells_per_station)
+
+    def get_assignments(self):
+        return dict(self._cells_per_station)
+
+    def add_assignments(self, assignments):
+        self._cells_per_station.update(assignments)
@@ -0,0 +1,75 @@
+import hashlib
+import json
+import os
+from os.path import exists, getmtime, getsize, join, splitext
+
+import numpy as np
+
+__all__ = [
+    'MANIFEST_FILE_NAME', 'load_manifest', 'dump_manifest', 'get_file_fingerprint', 'get_shape_file_fingerprint',
+    'get_combined_hash', 'get_yearly_fingerprints', 'get_state_path'
+]
+
+MANIFEST_FILE_NAME = 'manifest.json'
+SHAPE_FILE_EXTENSIONS = ('.shp', '.shx', '.dbf')
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def load_manifest(manifest_path):
+    if not exists(manifest_path):
+        return {}
+    with open(manifest_path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def dump_manifest(manifest_path, manifest):
+    temp_path = manifest_path + '.tmp'
+    with open(temp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    if exists(manifest_path):
+        os.remove(manifest_path)
+    os.rename(temp_path, manifest_path)
+
+
+def get_file_fingerprint(file_path, known_fingerprints):
+    size, mtime = getsize(file_path), getmtime(file_path)
+    known = known_fingerprints.get(file_path)
+    if known and known['size'] == size and known['mtime'] == mtime:
+        return known
+
+    file_hash = hashlib.md5()
+    with open(file_path, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(HASH_BLOCK_SIZE), b''):
+            file_hash.update(block)
+    return {'size': size, 'mtime': mtime, 'hash': file_hash.hexdigest()}
+
+
+def get_shape_file_fingerprint(shape_file_path, known_fingerprints):
+    base_path = splitext(shape_file_path)[0]
+    fingerprints = {}
+    for extension in SHAPE_FILE_EXTENSIONS:
+        if exists(base_path + extension):
+            fingerprints[base_path + extension] = get_file_fingerprint(base_path + extension, known_fingerprints)
+    return fingerprints
+
+
+def get_combined_hash(values):
+    combined_hash = hashlib.md5()
+    for value in values:
+        combined_hash.update(str(value).encode('utf-8'))
+    return combined_hash.hexdigest()
+
+
+def get_yearly_fingerprints(data_frame):
+    fingerprints = {}
+    years = data_frame.index.year
+    for year in np.unique(years):
+        rows = years == year
+        year_hash = hashlib.md5(np.ascontiguousarray(data_frame.index.values[rows]).tobytes())
+        year_hash.update(np.ascontiguousarray(data_frame.values[rows], dtype=np.float64).tobytes())
+        fingerprints[str(year)] = year_hash.hexdigest()
+    return fingerprints
+
+
+def get_state_path(state_dir_path, output_file_path):
+    return join(state_dir_path, os.path.basename(output_file_path) + '.json')
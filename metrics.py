@@ -0,0 +1,91 @@
+import json
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+__all__ = [
+    'METRICS_FILE_NAME', 'add_counter', 'add_time', 'timer', 'reset_metrics', 'get_metrics', 'append_metrics',
+    'measure_stage', 'load_metrics', 'get_metrics_summary', 'format_metrics_summary'
+]
+
+METRICS_FILE_NAME = 'metrics.jsonl'
+
+_metrics = {'counters': {}, 'timers': {}}
+
+
+def add_counter(name, value=1):
+    _metrics['counters'][name] = _metrics['counters'].get(name, 0) + value
+
+
+def add_time(name, seconds):
+    _metrics['timers'][name] = _metrics['timers'].get(name, 0.0) + seconds
+
+
+@contextmanager
+def timer(name):
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        add_time(name, time.time() - start_time)
+
+
+def reset_metrics():
+    _metrics['counters'] = {}
+    _metrics['timers'] = {}
+
+
+def get_metrics():
+    return {'counters': dict(_metrics['counters']), 'timers': dict(_metrics['timers'])}
+
+
+def append_metrics(metrics_path, record):
+    with open(metrics_path, 'a') as metrics_file:
+        metrics_file.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def measure_stage(metrics_path, stage, target, *args):
+    reset_metrics()
+    start_time = time.time()
+    result = target(*args)
+    record = {'task': stage, 'stage': stage, 'exitcode': 0, 'seconds': time.time() - start_time, 'peak_rss': None,
+              'finished': time.time()}
+    record.update(get_metrics())
+    append_metrics(metrics_path, record)
+    return result
+
+
+def load_metrics(metrics_path):
+    with open(metrics_path) as metrics_file:
+        return [json.loads(line) for line in metrics_file if line.strip()]
+
+
+def get_metrics_summary(records):
+    summary = OrderedDict()
+    for record in records:
+        stage = summary.setdefault(record.get('stage') or 'other', {'tasks': 0, 'failed': 0, 'seconds': 0.0,
+                                                                    'max_seconds': 0.0, 'peak_rss': None,
+                                                                    'counters': {}, 'timers': {}})
+        stage['tasks'] += 1
+        stage['failed'] += 1 if record.get('exitcode') else 0
+        stage['seconds'] += record['seconds']
+        stage['max_seconds'] = max(stage['max_seconds'], record['seconds'])
+        if record.get('peak_rss') is not None:
+            stage['peak_rss'] = max(stage['peak_rss'] or 0, record['peak_rss'])
+        for group in ('counters', 'timers'):
+            for name, value in record.get(group, {}).items():
+                stage[group][name] = stage[group].get(name, 0) + value
+    return summary
+
+
+def format_metrics_summary(summary):
+    lines = ['%-12s %6s %7s %10s %10s %10s  %s' % ('stage', 'tasks', 'failed', 'seconds', 'max s', 'peak MB',
+                                                   'counters / timers')]
+    for stage_name, stage in summary.items():
+        details = ['%s=%s' % (name, stage['counters'][name]) for name in sorted(stage['counters'])]
+        details.extend('%s=%.2fs' % (name, stage['timers'][name]) for name in sorted(stage['timers']))
+        lines.append('%-12s %6d %7d %10.2f %10.2f %10s  %s' % (
+            stage_name, stage['tasks'], stage['failed'], stage['seconds'], stage['max_seconds'],
+            'n/a' if stage['peak_rss'] is None else '%.1f' % (stage['peak_rss'] / 1024.0 / 1024.0),
+            ', '.join(details)))
+    return '\n'.join(lines)
@@ -0,0 +1,75 @@
+import logging
+import time
+from Queue import Queue, Full
+from threading import Event, Thread
+
+from metrics import add_counter, add_time
+
+__all__ = ['DEFAULT_PREFETCH_DEPTH', 'prefetch']
+
+DEFAULT_PREFETCH_DEPTH = 2
+PUT_TIMEOUT = 0.1
+
+_DONE = object()
+
+
+def prefetch(load, items, depth=DEFAULT_PREFETCH_DEPTH):
+    if depth <= 0:
+        for item in items:
+            start_time = time.time()
+            value = load(item)
+            seconds = time.time() - start_time
+            add_time('prefetch_read', seconds)
+            add_time('prefetch_wait', seconds)
+            yield item, value
+        return
+
+    loaded = Queue(maxsize=depth)
+    stopped = Event()
+    read_seconds = [0.0]
+    thread = Thread(target=load_items, args=(load, items, loaded, stopped, read_seconds))
+    thread.daemon = True
+    thread.start()
+
+    wait_seconds = 0.0
+    try:
+        while True:
+            start_time = time.time()
+            item, value, error = loaded.get()
+            wait_seconds += time.time() - start_time
+            if item is _DONE:
+                break
+            if error is not None:
+                raise error
+            add_counter('prefetched')
+            yield item, value
+    finally:
+        stopped.set()
+        thread.join()
+        add_time('prefetch_read', read_seconds[0])
+        add_time('prefetch_wait', wait_seconds)
+        add_time('io_hidden', max(0.0, read_seconds[0] - wait_seconds))
+
+
+def load_items(load, items, loaded, stopped, read_seconds):
+    for item in items:
+        start_time = time.time()
+        try:
+            result = (item, load(item), None)
+        except Exception as error:
+            logging.exception('Error occurred on prefetching %s', item)
+            result = (item, None, error)
+        read_seconds[0] += time.time() - start_time
+        if not put_item(loaded, stopped, result) or result[2] is not None:
+            return
+    put_item(loaded, stopped, (_DONE, None, None))
+
+
+def put_item(loaded, stopped, result):
+    while not stopped.is_set():
+        try:
+            loaded.put(result, timeout=PUT_TIMEOUT)
+            return True
+        except Full:
+            pass
+    return False
@@ -0,0 +1,134 @@
+import logging
+from os.path import join, basename, splitext, exists
+
+import numpy as np
+from numpy.lib.format import open_memmap
+import pandas as pd
+
+from utils import mkpath
+
+__all__ = [
+    'RAW_COLUMNS', 'REQUIRED_FIELDS', 'VALUE_FIELDS', 'COORDINATE_FIELDS', 'DEFAULT_CSV_CHUNK_SIZE', 'ingest_raw_csv',
+    'validate_raw_csv', 'dump_raw_data', 'load_raw_data', 'load_raw_data_coordinates', 'get_raw_data_path',
+    'get_station_slices'
+]
+
+RAW_COLUMNS = [0, 3, 4, 5, 8, 11, 12]
+REQUIRED_FIELDS = {"TMAX": 12, "TMIN": 13, "PRCP": 9}
+VALUE_FIELDS = ("PRCP", "TMAX", "TMIN")
+COORDINATE_FIELDS = ("LATITUDE", "LONGITUDE")
+DEFAULT_CSV_CHUNK_SIZE = 1000000
+RAW_DTYPES = {"STATION": str, "PRCP": np.float64, "TMAX": np.float64, "TMIN": np.float64}
+
+
+def get_missing_fields(csv_file_path):
+    header = pd.read_csv(csv_file_path, usecols=RAW_COLUMNS, nrows=0)
+    return [field for field in REQUIRED_FIELDS.keys() if field not in header.columns]
+
+
+def read_raw_csv_chunks(csv_file_path, chunk_size=DEFAULT_CSV_CHUNK_SIZE):
+    for chunk in pd.read_csv(csv_file_path, usecols=RAW_COLUMNS, na_values=-9999, dtype=RAW_DTYPES,
+                             parse_dates=["DATE"], chunksize=chunk_size):
+        yield chunk[chunk.STATION.notnull()]
+
+
+def ingest_raw_csv(cache_path, csv_file_station_rows, chunk_size=DEFAULT_CSV_CHUNK_SIZE):
+    csv_file_path, station_rows = csv_file_station_rows
+    try:
+        missing_fields = get_missing_fields(csv_file_path)
+        if not missing_fields:
+            dump_raw_data(cache_path, csv_file_path, station_rows, chunk_size)
+    except ValueError:
+        missing_fields = list(REQUIRED_FIELDS.keys())
+    return csv_file_path, missing_fields
+
+
+def validate_raw_csv(csv_file_path, chunk_size=DEFAULT_CSV_CHUNK_SIZE):
+    try:
+        missing_fields = get_missing_fields(csv_file_path)
+        if missing_fields:
+            return csv_file_path, None, missing_fields
+
+        counts = pd.Series([], dtype=np.int64)
+        for chunk in pd.read_csv(csv_file_path, usecols=RAW_COLUMNS[:1], dtype=str, chunksize=chunk_size):
+            counts = counts.add(chunk.iloc[:, 0].value_counts(), fill_value=0)
+    except ValueError:
+        return csv_file_path, None, list(REQUIRED_FIELDS.keys())
+    return csv_file_path, dict((station, int(count)) for station, count in counts.items()), []
+
+
+def get_raw_data_path(cache_path, csv_file_path):
+    return join(cache_path, splitext(basename(csv_file_path))[0])
+
+
+def dump_raw_data(cache_path, csv_file_path, station_rows, chunk_size=DEFAULT_CSV_CHUNK_SIZE):
+    raw_data_path = get_raw_data_path(cache_path, csv_file_path)
+    mkpath(raw_data_path)
+
+    stations = np.array(sorted(station_rows.keys()), dtype=object)
+    counts = np.array([station_rows[station] for station in stations], dtype=np.int64)
+    offsets = np.append(0, np.cumsum(counts))
+    np.save(join(raw_data_path, 'stations.npy'), np.array(stations.tolist()))
+    np.save(join(raw_data_path, 'offsets.npy'), offsets)
+
+    rows_count = int(offsets[-1])
+    columns = {'DATE': open_memmap(join(raw_data_path, 'date.npy'), mode='w+', dtype='datetime64[ns]',
+                                   shape=(rows_count,))}
+    for field in VALUE_FIELDS:
+        columns[field] = open_memmap(join(raw_data_path, field.lower() + '.npy'), mode='w+', dtype=np.float64,
+                                     shape=(rows_count,))
+    coordinates = dict((field, np.full(stations.shape[0], np.NaN)) for field in COORDINATE_FIELDS)
+
+    written = np.zeros(stations.shape[0], dtype=np.int64)
+    for chunk in read_raw_csv_chunks(csv_file_path, chunk_size):
+        codes = np.searchsorted(stations, chunk.STATION.values)
+        if np.any(codes == stations.shape[0]) or np.any(stations[codes] != chunk.STATION.values):
+            raise Exception('File %s has stations that were not found on validation' % basename(csv_file_path))
+        order = np.argsort(codes, kind='mergesort')
+        chunk_codes, first_rows, chunk_counts = np.unique(codes[order], return_index=True, return_counts=True)
+        if np.any(written[chunk_codes] + chunk_counts > counts[chunk_codes]):
+            raise Exception('File %s has more rows than were found on validation' % basename(csv_file_path))
+        ranks = np.arange(order.shape[0]) - np.repeat(first_rows, chunk_counts)
+        positions = offsets[codes[order]] + written[codes[order]] + ranks
+        for field, column in columns.items():
+            column[positions] = chunk[field].values[order]
+
+        new_codes = written[chunk_codes] == 0
+        for field in COORDINATE_FIELDS:
+            if field in chunk.columns:
+                values = pd.to_numeric(chunk[field], errors='coerce').values[order]
+                coordinates[field][chunk_codes[new_codes]] = values[first_rows[new_codes]]
+        written[chunk_codes] += chunk_counts
+
+    if np.any(written != counts):
+        raise Exception('File %s has less rows than were found on validation' % basename(csv_file_path))
+    for column in columns.values():
+        column.flush()
+    for field in COORDINATE_FIELDS:
+        np.save(join(raw_data_path, field.lower() + '.npy'), coordinates[field])
+    logging.info('Raw data of %s stored in %s', basename(csv_file_path), raw_data_path)
+    return stations.tolist()
+
+
+def load_raw_data(cache_path, csv_file_path):
+    raw_data_path = get_raw_data_path(cache_path, csv_file_path)
+    raw_data = {}
+    for name in ('stations', 'offsets', 'date') + tuple(field.lower() for field in VALUE_FIELDS):
+        raw_data[name] = np.load(join(raw_data_path, name + '.npy'), mmap_mode='r')
+    return raw_data
+
+
+def load_raw_data_coordinates(cache_path, csv_file_path):
+    raw_data_path = get_raw_data_path(cache_path, csv_file_path)
+    stations = np.load(join(raw_data_path, 'stations.npy')).tolist()
+    coordinates = {'STATION': stations}
+    for field in COORDINATE_FIELDS:
+        field_path = join(raw_data_path, field.lower() + '.npy')
+        coordinates[field] = np.load(field_path) if exists(field_path) else np.full(len(stations), np.NaN)
+    return coordinates
+
+
+def get_station_slices(raw_data):
+    offsets = raw_data['offsets']
+    return [(station, slice(offsets[idx], offsets[idx + 1]))
+            for idx, station in enumerate(raw_data['stations'].tolist())]
@@ -0,0 +1,64 @@
+from os.path import exists
+
+from metrics import add_counter, timer
+from utils import delete, replace_file
+
+__all__ = ['ReportWriter', 'DEFAULT_BUFFER_SIZE', 'DEFAULT_CHUNK_SIZE']
+
+DEFAULT_BUFFER_SIZE = 1 << 20
+DEFAULT_CHUNK_SIZE = 10000
+
+
+class ReportWriter(object):
+    def __init__(self, path, header, buffer_size=DEFAULT_BUFFER_SIZE, keep_before=None, observer=None):
+        self.path = path
+        self.temp_path = path + '.tmp'
+        self.header = header
+        self.buffer_size = buffer_size
+        self.keep_before = keep_before
+        self.observer = observer
+        self.output_file = None
+
+    def __enter__(self):
+        self.output_file = open(self.temp_path, 'w', self.buffer_size)
+        if self.keep_before is not None and exists(self.path):
+            self.copy_lines_before(self.keep_before)
+        else:
+            self.output_file.write(','.join(self.header) + '\n')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.output_file.close()
+        if exc_type is None:
+            replace_file(self.temp_path, self.path)
+        else:
+            delete(self.temp_path)
+
+    def copy_lines_before(self, since):
+        with open(self.path) as report_file:
+            self.output_file.write(report_file.readline())
+            for line in report_file:
+                if line[:len(since)] >= since:
+                    break
+                self.output_file.write(line)
+
+    def write_lines(self, lines, chunk_size=DEFAULT_CHUNK_SIZE):
+        chunk = []
+        for line in lines:
+            chunk.append(line)
+            if len(chunk) == chunk_size:
+                self.write_chunk(chunk)
+                chunk = []
+        self.write_chunk(chunk)
+
+    def write_chunks(self, chunks):
+        for chunk in chunks:
+            self.write_chunk(chunk)
+
+    def write_chunk(self, chunk):
+        if self.observer is not None:
+            self.observer(chunk)
+        data = ''.join(chunk)
+        with timer('write'):
+            self.output_file.write(data)
+        add_counter('bytes_written', len(data))
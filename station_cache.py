@@ -0,0 +1,124 @@
+import logging
+import os
+from collections import OrderedDict
+from os.path import exists, getmtime, getsize, splitext
+
+from grid_index import NearestStationIndex, get_grid_cells
+from manifest import SHAPE_FILE_EXTENSIONS, get_combined_hash
+from utils import load_basein_file
+
+__all__ = ['DEFAULT_CACHE_BUDGET', 'STATION_INDEX_CACHE_SUPPORTED', 'LRUCache', 'set_station_index_cache',
+           'load_station_index', 'publish_station_index', 'collect_station_indexes']
+
+DEFAULT_CACHE_BUDGET = 512 << 20
+STATION_INDEX_CACHE_SUPPORTED = hasattr(os, 'fork')
+
+_cache = None
+_published = None
+_lookups = {}
+
+
+class LRUCache(object):
+    def __init__(self, budget=DEFAULT_CACHE_BUDGET):
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def peek(self, key):
+        value, size = self.entries.pop(key)
+        self.entries[key] = (value, size)
+        return value
+
+    def put(self, key, value, size):
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+        self.entries[key] = (value, size)
+        self.size += size
+        while self.size > self.budget and len(self.entries) > 1:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+
+    def add_lookup(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def stats(self):
+        return {'entries': len(self.entries), 'size': self.size, 'budget': self.budget, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+
+def set_station_index_cache(cache, published=None):
+    global _cache, _published
+    _cache = cache
+    _published = published
+
+
+def get_shape_file_stamp(shape_file_path):
+    base_path = splitext(shape_file_path)[0]
+    return tuple((extension, getsize(base_path + extension), getmtime(base_path + extension))
+                 for extension in SHAPE_FILE_EXTENSIONS if exists(base_path + extension))
+
+
+def get_grid_key(basein_file_path):
+    return basein_file_path, get_shape_file_stamp(basein_file_path)
+
+
+def get_section_stations_key(section_stations):
+    return get_combined_hash(sorted(section_stations.items()))
+
+
+def get_grid_entry_size(grid_entry):
+    return grid_entry['cells'].nbytes + sum(cells_per_station.nbytes
+                                            for assignments in grid_entry['assignments'].values()
+                                            for cells_per_station in assignments.values())
+
+
+def load_station_index(basein_file_path, grids_cache_path, section_stations):
+    if _cache is not None:
+        grid_key = get_grid_key(basein_file_path)
+        _lookups[basein_file_path] = grid_key in _cache
+        if grid_key in _cache:
+            logging.info('Using cached grid of %s', basein_file_path)
+            grid_entry = _cache.peek(grid_key)
+            station_index = NearestStationIndex(grid_entry['cells'], section_stations)
+            station_index.add_assignments(grid_entry['assignments'].get(get_section_stations_key(section_stations),
+                                                                        {}))
+            return station_index
+
+    x, y, masks_array = load_basein_file(basein_file_path, grids_cache_path)
+    return NearestStationIndex(get_grid_cells(x, y, masks_array), section_stations)
+
+
+def publish_station_index(basein_file_path, station_index):
+    if _published is None:
+        return
+    grid_key = get_grid_key(basein_file_path)
+    cells = None if grid_key in _cache else station_index.cells
+    _published[(grid_key, get_section_stations_key(station_index.section_stations))] = (
+        cells, station_index.get_assignments(), _lookups.pop(basein_file_path, False))
+
+
+def collect_station_indexes():
+    if _published is None:
+        return
+    for (grid_key, stations_key), (cells, assignments, hit) in _published.items():
+        _cache.add_lookup(hit)
+        if grid_key in _cache:
+            grid_entry = _cache.peek(grid_key)
+        elif cells is not None:
+            grid_entry = {'cells': cells, 'assignments': {}}
+        else:
+            continue
+        grid_entry['assignments'].setdefault(stations_key, {}).update(assignments)
+        _cache.put(grid_key, grid_entry, get_grid_entry_size(grid_entry))
+    _published.clear()
+    logging.info('Station index cache: %s', _cache.stats())
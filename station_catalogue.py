@@ -0,0 +1,101 @@
+import csv
+import logging
+from os.path import basename
+
+import numpy as np
+import shapefile
+
+from raw_data import load_raw_data_coordinates
+
+__all__ = [
+    'CATALOGUE_FILE_NAME', 'NAME_STATION_MATCHING', 'LOCATION_STATION_MATCHING', 'STATION_MATCHING_MODES',
+    'build_station_catalogue', 'dump_station_catalogue', 'load_station_catalogue', 'get_catalogue_coordinates',
+    'StationLocationIndex'
+]
+
+CATALOGUE_FILE_NAME = 'stations_catalogue.csv'
+CATALOGUE_HEADER = ['STATION', 'FILE', 'LATITUDE', 'LONGITUDE']
+NAME_STATION_MATCHING = 'name'
+LOCATION_STATION_MATCHING = 'location'
+STATION_MATCHING_MODES = (NAME_STATION_MATCHING, LOCATION_STATION_MATCHING)
+POLYGON_SHAPE_TYPES = (shapefile.POLYGON, shapefile.POLYGONZ, shapefile.POLYGONM)
+
+
+def build_station_catalogue(csv_stations, raw_data_path):
+    catalogue = {}
+    for csv_file_path, _ in csv_stations:
+        coordinates = load_raw_data_coordinates(raw_data_path, csv_file_path)
+        for station, latitude, longitude in zip(coordinates['STATION'], coordinates['LATITUDE'],
+                                                coordinates['LONGITUDE']):
+            catalogue[station] = (csv_file_path, float(latitude), float(longitude))
+    logging.info('Station catalogue contains %d stations', len(catalogue))
+    return catalogue
+
+
+def dump_station_catalogue(catalogue_path, catalogue):
+    with open(catalogue_path, 'wb') as catalogue_file:
+        writer = csv.writer(catalogue_file)
+        writer.writerow(CATALOGUE_HEADER)
+        for station in sorted(catalogue.keys()):
+            csv_file_path, latitude, longitude = catalogue[station]
+            writer.writerow([station, csv_file_path, repr(latitude), repr(longitude)])
+
+
+def load_station_catalogue(catalogue_path):
+    catalogue = {}
+    with open(catalogue_path, 'rb') as catalogue_file:
+        reader = csv.reader(catalogue_file)
+        next(reader)
+        for station, csv_file_path, latitude, longitude in reader:
+            catalogue[station] = (csv_file_path, float(latitude), float(longitude))
+    return catalogue
+
+
+def get_catalogue_coordinates(catalogue, stations):
+    coordinates = {}
+    for station in stations:
+        if station in catalogue:
+            _, latitude, longitude = catalogue[station]
+            if not (np.isnan(latitude) or np.isnan(longitude)):
+                coordinates[station] = (longitude, latitude)
+    return coordinates
+
+
+class StationLocationIndex(object):
+    def __init__(self, catalogue):
+        located = sorted((longitude, latitude, station) for station, (_, latitude, longitude) in catalogue.items()
+                         if not (np.isnan(latitude) or np.isnan(longitude)))
+        self.x = np.array([longitude for longitude, _, _ in located], dtype=float)
+        self.y = np.array([latitude for _, latitude, _ in located], dtype=float)
+        self.stations = [station for _, _, station in located]
+
+    def get_stations_inside(self, shape_file_path):
+        shape_file = shapefile.Reader(shape_file_path)
+        inside = np.zeros(len(self.stations), dtype=bool)
+        for shape in shape_file.shapes():
+            if shape.shapeType in POLYGON_SHAPE_TYPES:
+                self.mark_points_inside(shape, inside)
+        stations = set(station for station, is_inside in zip(self.stations, inside) if is_inside)
+        logging.info('Stations located inside shapes of %s: %s', basename(shape_file_path), stations)
+        return stations
+
+    def mark_points_inside(self, shape, inside):
+        min_x, min_y, max_x, max_y = shape.bbox
+        candidates = np.arange(np.searchsorted(self.x, min_x, side='left'),
+                               np.searchsorted(self.x, max_x, side='right'))
+        candidates = candidates[(self.y[candidates] >= min_y) & (self.y[candidates] <= max_y)]
+        if candidates.shape[0]:
+            inside[candidates] |= points_inside_polygon(self.x[candidates], self.y[candidates], shape)
+
+
+def points_inside_polygon(x, y, shape):
+    points = np.array(shape.points, dtype=float)[:, :2]
+    inside = np.zeros(x.shape[0], dtype=bool)
+    for start, stop in zip(shape.parts, list(shape.parts[1:]) + [points.shape[0]]):
+        ring = points[start:stop]
+        for (x1, y1), (x2, y2) in zip(ring, np.roll(ring, -1, axis=0)):
+            if y1 == y2:
+                continue
+            crosses = (y1 > y) != (y2 > y)
+            inside ^= crosses & (x < x1 + (y - y1) * (x2 - x1) / (y2 - y1))
+    return inside
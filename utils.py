@@ -1,20 +1,33 @@
+import cProfile
 import logging
+import pstats
 import re
 from distutils.dir_util import remove_tree
 from glob import glob
-from os.path import join, isdir, isfile, islink, exists, basename, dirname
+from os.path import join, isdir, isfile, islink, exists, basename, dirname, getsize
 import numpy
-import pandas
 import os
-from multiprocessing import Process
+import time
+from multiprocessing import Pool, Process, Queue, cpu_count
+from Queue import Empty
+from StringIO import StringIO
 from stat import S_IWUSR, S_IWGRP, S_IWOTH, ST_MODE
 import shapefile
 import sys
 
+from manifest import get_shape_file_fingerprint, get_combined_hash
+from metrics import append_metrics, get_metrics, reset_metrics
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
 __all__ = [
-    'configure_logging', 'run_tasks', 'clear_dir', 'load_basein_file',
+    'configure_logging', 'run_tasks', 'map_tasks', 'clear_dir', 'mkpath', 'load_basein_file',
     'load_section_file', 'get_shape_file_and_correspondent_stations',
-    'get_files_for_getting_daily_metrics', 'LOG_FILE_NAME'
+    'get_files_for_getting_daily_metrics', 'get_config_value', 'get_config_flag', 'get_files_size',
+    'LOG_FILE_NAME'
 ]
 
 LOGGING_FORMAT = '%(asctime)-15s %(levelname)s %(message)s'
@@ -22,6 +35,7 @@ DATE_FORMAT = '[%Y-%m-%d %H:%M:%S]'
 LOG_FILE_NAME = join(dirname(sys.argv[0]), 'process.log')
 
 WRITE = S_IWUSR | S_IWGRP | S_IWOTH
+PROFILE_SUMMARY_SIZE = 20
 
 
 def configure_logging(filename='app.log', level=logging.DEBUG):
@@ -36,15 +50,33 @@ def configure_logging(filename='app.log', level=logging.DEBUG):
 configure_logging(LOG_FILE_NAME)
 
 
-def get_shape_file_and_correspondent_stations(csv_data_path, shape_files_path):
+def get_config_value(config, section, option, default):
+    if config.has_option(section, option):
+        value = config.get(section, option).strip()
+        if value:
+            return value
+    return default
+
+
+def get_config_flag(config, section, option, default):
+    value = get_config_value(config, section, option, None)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'yes', 'true', 'on')
+
+
+def get_shape_file_and_correspondent_stations(station_catalogue, shape_files_path, location_index=None):
     logging.info('Getting correspondent station for shape files')
     stations_inside_shapes_data = {}
     for shape_file_path in glob(join(shape_files_path, '*.shp')):
         stations_inside_shapes_data[shape_file_path] = {}
 
         shape_file_stations = get_station_names_from_shape_file(shape_file_path)
-        for file_name, station in get_stations_in_file(csv_data_path):
-            if station in shape_file_stations:
+        if location_index is not None:
+            shape_file_stations |= location_index.get_stations_inside(shape_file_path)
+        for station in shape_file_stations:
+            if station in station_catalogue:
+                file_name = station_catalogue[station][0]
                 if file_name not in stations_inside_shapes_data[shape_file_path]:
                     stations_inside_shapes_data[shape_file_path][file_name] = set()
                 stations_inside_shapes_data[shape_file_path][file_name].add(station)
@@ -59,6 +91,8 @@ def get_shape_file_and_correspondent_stations(csv_data_path, shape_files_path):
 def get_station_names_from_shape_file(shape_file_name):
     shape_file = shapefile.Reader(shape_file_name)
     station_idx = get_field_index(shape_file, 'STATION')
+    if station_idx is None:
+        return set()
     stations = set([record[station_idx] for record in shape_file.records()])
     logging.info('Stations in shape file %s: %s', shape_file_name, stations)
     return stations
@@ -66,29 +100,137 @@ def get_station_names_from_shape_file(shape_file_name):
 
 def get_field_index(shape_file, field_name):
     fieldnames = [field[0] for field in shape_file.fields]
+    if field_name not in fieldnames:
+        return None
     return fieldnames.index(field_name) - 1
 
 
-def get_stations_in_file(csv_data_path):
-    if not isdir(csv_data_path):
-        raise Exception('csv data folder path not found on path: %s' % csv_data_path)
-    for csv_file_path in glob(join(csv_data_path, '*.csv')):
-        csv_file = pandas.read_csv(csv_file_path, usecols=[0])
-        for station in csv_file.STATION.unique():
-            yield csv_file_path, station
+def run_tasks(tasks_description, workers=None, keep_going=False, metrics_path=None):
+    workers = workers or cpu_count()
+    pending = sorted(tasks_description, key=lambda task_desc: task_desc.get('size', 0), reverse=True)
+    logging.info('Running %d tasks on %d workers', len(pending), workers)
+
+    stats_queue = Queue()
+    tasks_stats = {}
+    running = {}
+    finished = set()
+    failed = set()
+    failures = []
+    while pending or running:
+        for task_desc in list(pending):
+            if len(running) >= workers:
+                break
+            depends_on = task_desc.get('depends_on', ())
+            failed_dependencies = [dependency for dependency in depends_on if dependency in failed]
+            if failed_dependencies:
+                pending.remove(task_desc)
+                failed.add(get_task_name(task_desc))
+                failures.append('Task %s is skipped because of failed tasks: %s' % (get_task_name(task_desc),
+                                                                                    ', '.join(failed_dependencies)))
+                continue
+            if any(dependency not in finished for dependency in depends_on):
+                continue
+            pending.remove(task_desc)
+            name = get_task_name(task_desc)
+            task = Process(target=run_task_with_stats, args=(name, task_desc['target'], task_desc['args'], stats_queue,
+                                                             task_desc.get('profile_path')))
+            task.start()
+            running[name] = (task, time.time(), task_desc)
+
+        if pending and not running:
+            raise Exception('Could not resolve dependencies of tasks: %s' % ', '.join(
+                get_task_name(task_desc) for task_desc in pending))
+
+        collect_tasks_stats(stats_queue, tasks_stats)
+        for name, (task, start_time, task_desc) in list(running.items()):
+            if task.is_alive():
+                continue
+            task.join()
+            del running[name]
+            collect_tasks_stats(stats_queue, tasks_stats, timeout=0)
+            peak_rss, task_metrics = tasks_stats.get(name, (None, {}))
+            seconds = time.time() - start_time
+            logging.info('Task %s finished with code %s in %.1f s, peak RSS: %s', name, task.exitcode, seconds,
+                         format_memory_size(peak_rss))
+            if metrics_path:
+                record = {'task': name, 'stage': task_desc.get('stage'), 'exitcode': task.exitcode,
+                          'seconds': seconds, 'peak_rss': peak_rss, 'finished': time.time()}
+                record.update(task_metrics)
+                append_metrics(metrics_path, record)
+            if task.exitcode != 0:
+                failed.add(name)
+                failures.append('Task %s is finished with not-zero code: %s' % (name, task.exitcode))
+                if not keep_going:
+                    terminate_tasks([running_task for running_task, _, _ in running.values()])
+                    raise Exception(failures[0])
+            else:
+                finished.add(name)
+
+    if failures:
+        raise Exception('%d of %d tasks failed:\n%s' % (len(failures), len(tasks_description), '\n'.join(failures)))
+
+
+def map_tasks(target, items, workers=None, initializer=None, initargs=()):
+    pool = Pool(workers or cpu_count(), initializer, initargs)
+    try:
+        return pool.map(target, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def get_task_name(task_desc):
+    if 'name' in task_desc:
+        return task_desc['name']
+    return '%s%s' % (task_desc['target'].__name__, task_desc['args'])
+
+
+def run_task_with_stats(name, target, args, stats_queue, profile_path=None):
+    reset_metrics()
+    try:
+        if profile_path:
+            profile = cProfile.Profile()
+            profile.runcall(target, *args)
+            profile.dump_stats(profile_path)
+            profile_summary = StringIO()
+            pstats.Stats(profile, stream=profile_summary).sort_stats('cumulative').print_stats(PROFILE_SUMMARY_SIZE)
+            logging.info('Profile of task %s stored in %s\n%s', name, profile_path, profile_summary.getvalue())
+        else:
+            target(*args)
+    finally:
+        stats_queue.put((name, get_peak_rss(), get_metrics()))
+
 
+def collect_tasks_stats(stats_queue, tasks_stats, timeout=0.2):
+    try:
+        while True:
+            name, rss, task_metrics = stats_queue.get(timeout=timeout) if timeout else stats_queue.get_nowait()
+            tasks_stats[name] = (rss, task_metrics)
+    except Empty:
+        pass
 
-def run_tasks(tasks_description):
-    tasks = []
-    for task_desc in tasks_description:
-        task = Process(target=task_desc['target'], args=task_desc['args'])
-        task.start()
-        tasks.append(task)
 
+def terminate_tasks(tasks):
     for task in tasks:
+        task.terminate()
         task.join()
-        if task.exitcode != 0:
-            raise Exception('Task %s is finished with not-zero code: %s' % (task, task.exitcode))
+
+
+def get_peak_rss():
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+
+def format_memory_size(size):
+    if size is None:
+        return 'n/a'
+    return '%.1f MB' % (size / 1024.0 / 1024.0)
+
+
+def get_files_size(paths):
+    return sum(getsize(path) for path in paths if isfile(path))
 
 
 def clear_dir(path):
@@ -123,12 +265,41 @@ def add_permissions_to_dir_rec(path, permissions):
         add_permissions_to_multiple_paths(root, dirs + files, permissions)
 
 
+def replace_file(source_path, destination_path):
+    if sys.platform == 'win32' and exists(destination_path):
+        delete(destination_path)
+    os.rename(source_path, destination_path)
+
+
 def mkpath(path):
     if not isdir(path):
         os.makedirs(path)
 
 
-def load_basein_file(shape_file_path):
+def load_basein_file(shape_file_path, cache_path=None):
+    if cache_path is None:
+        return read_basein_file(shape_file_path)
+
+    shape_file_fingerprint = get_shape_file_fingerprint(shape_file_path, {})
+    cache_key = get_combined_hash(shape_file_fingerprint[path]['hash'] for path in sorted(shape_file_fingerprint))
+    cache_file_path = join(cache_path, cache_key + '.npz')
+    if isfile(cache_file_path):
+        logging.info('Loading grid of %s from cache %s', basename(shape_file_path), cache_file_path)
+        with numpy.load(cache_file_path) as grid:
+            return grid['x'], grid['y'], grid['masks_array']
+
+    x, y, masks_array = read_basein_file(shape_file_path)
+    mkpath(cache_path)
+    temp_file_path = '%s.%d.tmp.npz' % (cache_file_path, os.getpid())
+    numpy.savez(temp_file_path, x=x, y=y, masks_array=masks_array)
+    try:
+        os.rename(temp_file_path, cache_file_path)
+    except OSError:
+        delete(temp_file_path)
+    return x, y, masks_array
+
+
+def read_basein_file(shape_file_path):
     shape_file = shapefile.Reader(shape_file_path)
     x_idx, y_idx, mask_idx = get_fields_indexes(shape_file)
 
@@ -138,20 +309,14 @@ def load_basein_file(shape_file_path):
 
 
 def read_record_values(shape_file, mask_idx, x_idx, y_idx):
-    x_array = []
-    y_array = []
-    masks_array = []
-    for record_index in range(shape_file.numRecords):
-        record = shape_file.record(record_index)
-        masks_array.append(int(record[mask_idx] != 'n'))
-
-        if x_idx:
-            x, y = float(record[x_idx]), float(record[y_idx])
-        else:
-            x, y = compute_coordinates_from_record(shape_file, record_index)
+    records = shape_file.records()
+    masks_array = numpy.array([record[mask_idx] != 'n' for record in records], dtype=int)
 
-        x_array.append(x)
-        y_array.append(y)
+    if x_idx is not None:
+        x_array = numpy.array([record[x_idx] for record in records], dtype=float)
+        y_array = numpy.array([record[y_idx] for record in records], dtype=float)
+    else:
+        x_array, y_array = compute_coordinates_from_shapes(shape_file)
 
     return x_array, y_array, masks_array
 
@@ -167,12 +332,11 @@ def get_fields_indexes(shape_file):
     return x_idx, y_idx, mask_idx
 
 
-def compute_coordinates_from_record(shape_file, record_index):
-    shape = shape_file.shape(record_index)
-    xmin, ymin, xmax, ymax = shape.bbox
-    x = (xmin + xmax) / 2.0
-    y = (ymin + ymax) / 2.0
-    return x, y
+def compute_coordinates_from_shapes(shape_file):
+    bboxes = numpy.array([shape.bbox for shape in shape_file.shapes()], dtype=float).reshape(-1, 4)
+    x_array = (bboxes[:, 0] + bboxes[:, 2]) / 2.0
+    y_array = (bboxes[:, 1] + bboxes[:, 3]) / 2.0
+    return x_array, y_array
 
 
 def process_record_raw_arrays(raw_x_array, raw_y_array, raw_masks_array):
@@ -193,10 +357,12 @@ def process_record_raw_arrays(raw_x_array, raw_y_array, raw_masks_array):
 
 def load_section_file(shape_file_path):
     shape_file = shapefile.Reader(shape_file_path)
-    fieldnames = [field[0] for field in shape_file.fields]
-    station_idx = fieldnames.index("STATION") - 1
+    station_idx = get_field_index(shape_file, "STATION")
 
     stations = {}
+    if station_idx is None:
+        logging.info('Section file %s has no STATION field', shape_file_path)
+        return stations
     for record_index in range(shape_file.numRecords):
         station = shape_file.record(record_index)[station_idx]
         if station.strip():
@@ -209,10 +375,11 @@ def load_section_file(shape_file_path):
     return stations
 
 
-def get_files_for_getting_daily_metrics(basein_files_root, section_files_root, data_files_root):
+def get_files_for_getting_daily_metrics(basein_files_root, section_files_root, data_files_root, data_files_extension,
+                                        expected_data_files=()):
     basein_files_registry = create_files_registry(basein_files_root, '*.shp')
     section_files_registry = create_files_registry(section_files_root, '*.shp')
-    data_files_registry = create_files_registry(data_files_root, '*.csv')
+    data_files_registry = create_files_registry(data_files_root, '*' + data_files_extension, expected_data_files)
 
     files_registry = []
     for key in basein_files_registry.keys():
@@ -225,10 +392,12 @@ def get_files_for_getting_daily_metrics(basein_files_root, section_files_root, d
     return files_registry
 
 
-def create_files_registry(files_path, pattern):
+def create_files_registry(files_path, pattern, expected_files=()):
     registry = {}
     path_pattern = join(files_path, pattern)
-    for file_path in glob(path_pattern):
+    files = glob(path_pattern)
+    files.extend(file_path for file_path in expected_files if file_path not in files)
+    for file_path in files:
         search_result = re.search('\d+', basename(file_path))
         if search_result is None:
             raise Exception('Could not extract session number from file name: %s' % file_path)
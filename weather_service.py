@@ -0,0 +1,168 @@
+import argparse
+import json
+import logging
+import socket
+import time
+from SocketServer import StreamRequestHandler, ThreadingTCPServer
+from glob import glob
+from multiprocessing import Manager
+from os.path import getmtime, getsize, join
+from threading import Event, Lock, Thread
+
+from generate_weather_report import create_weather_reports, load_config
+from station_cache import DEFAULT_CACHE_BUDGET, STATION_INDEX_CACHE_SUPPORTED, LRUCache, set_station_index_cache, \
+    collect_station_indexes
+from utils import get_config_value
+
+SERVICE_HOST = '127.0.0.1'
+DEFAULT_SERVICE_PORT = 8765
+DEFAULT_POLL_INTERVAL = 10.0
+COMMANDS = ('status', 'run', 'stop')
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Keep weather reports up to date while csv files change')
+    parser.add_argument('command', nargs='?', default='serve', choices=('serve',) + COMMANDS,
+                        help='"serve" starts the service, other commands are sent to a running service')
+    parser.add_argument('--port', type=int, help='local port of the service, [service] port in paths.cfg by default')
+    return parser.parse_args()
+
+
+def get_csv_files_snapshot(csv_data_path):
+    snapshot = {}
+    for csv_file_path in glob(join(csv_data_path, '*.csv')):
+        try:
+            snapshot[csv_file_path] = (getsize(csv_file_path), getmtime(csv_file_path))
+        except OSError:
+            pass
+    return snapshot
+
+
+class WeatherReportService(object):
+    def __init__(self, csv_data_path, poll_interval=DEFAULT_POLL_INTERVAL, cache_budget=DEFAULT_CACHE_BUDGET):
+        self.csv_data_path = csv_data_path
+        self.poll_interval = poll_interval
+        self.cache = LRUCache(cache_budget) if STATION_INDEX_CACHE_SUPPORTED else None
+        self.run_requested = Event()
+        self.stopped = Event()
+        self.lock = Lock()
+        self.last_snapshot = None
+        self.processed_snapshot = None
+        self.status = {'state': 'idle', 'runs': 0, 'failed_runs': 0, 'last_started': None, 'last_finished': None,
+                       'last_seconds': None, 'last_error': None}
+
+    def get_status(self):
+        with self.lock:
+            status = dict(self.status)
+        status['pending_changes'] = self.last_snapshot != self.processed_snapshot
+        status['csv_files'] = len(self.last_snapshot or {})
+        status['cache'] = self.cache.stats() if self.cache is not None else None
+        return status
+
+    def set_status(self, **values):
+        with self.lock:
+            self.status.update(values)
+
+    def request_run(self):
+        self.run_requested.set()
+
+    def stop(self):
+        self.stopped.set()
+        self.run_requested.set()
+
+    def serve_forever(self):
+        logging.info('Watching %s every %.1f s', self.csv_data_path, self.poll_interval)
+        while not self.stopped.is_set():
+            snapshot = get_csv_files_snapshot(self.csv_data_path)
+            settled = snapshot == self.last_snapshot
+            self.last_snapshot = snapshot
+            if self.run_requested.is_set() or (settled and snapshot != self.processed_snapshot):
+                self.run_requested.clear()
+                self.run_update(snapshot)
+            self.run_requested.wait(self.poll_interval)
+        logging.info('Service is stopped')
+
+    def run_update(self, snapshot):
+        start_time = time.time()
+        self.set_status(state='running', last_started=start_time)
+        try:
+            create_weather_reports(incremental=True)
+            self.processed_snapshot = snapshot
+            self.set_status(last_error=None)
+        except Exception as error:
+            logging.exception('Error on updating weather reports')
+            self.set_status(last_error=str(error), failed_runs=self.status['failed_runs'] + 1)
+        finally:
+            collect_station_indexes()
+            self.set_status(state='idle', runs=self.status['runs'] + 1, last_finished=time.time(),
+                            last_seconds=time.time() - start_time)
+
+
+class ServiceRequestHandler(StreamRequestHandler):
+    def handle(self):
+        command = self.rfile.readline().strip()
+        service = self.server.service
+        if command == 'status':
+            response = service.get_status()
+        elif command == 'run':
+            service.request_run()
+            response = {'queued': True}
+        elif command == 'stop':
+            service.stop()
+            response = {'stopping': True}
+        else:
+            response = {'error': 'Unknown command: %s' % command}
+        self.wfile.write(json.dumps(response, sort_keys=True) + '\n')
+
+
+def serve(port):
+    config = load_config()
+    service = WeatherReportService(config.get('paths', 'csv_data_path'),
+                                   float(get_config_value(config, 'service', 'poll_interval', DEFAULT_POLL_INTERVAL)),
+                                   int(get_config_value(config, 'service', 'cache_budget', DEFAULT_CACHE_BUDGET)))
+    manager = None
+    if service.cache is not None:
+        manager = Manager()
+        set_station_index_cache(service.cache, manager.dict())
+        logging.info('Station index cache is shared with daily tasks started by fork')
+    else:
+        logging.warning('Station index cache is disabled: daily tasks can get it only by fork, which is not '
+                        'available on this platform')
+
+    ThreadingTCPServer.allow_reuse_address = True
+    server = ThreadingTCPServer((SERVICE_HOST, port), ServiceRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    server_thread = Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    logging.info('Service listens on %s:%d', SERVICE_HOST, port)
+    try:
+        service.serve_forever()
+    finally:
+        server.shutdown()
+        server.server_close()
+        if manager is not None:
+            manager.shutdown()
+
+
+def send_command(port, command):
+    connection = socket.create_connection((SERVICE_HOST, port))
+    try:
+        connection.sendall(command + '\n')
+        return json.loads(connection.makefile().readline())
+    finally:
+        connection.close()
+
+
+def main():
+    arguments = parse_arguments()
+    port = arguments.port or int(get_config_value(load_config(), 'service', 'port', DEFAULT_SERVICE_PORT))
+    if arguments.command == 'serve':
+        serve(port)
+    else:
+        print(json.dumps(send_command(port, arguments.command), indent=1, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()